@@ -38,6 +38,15 @@ app.layout = dbc.Container(
 # This call will be used with Gunicorn server
 server = app.server
 
+# HTTP batch prediction API, shares the models of the prediction page
+from components.predict.api import register_prediction_api
+from pages.predict.breast_cancer_prediction import models
+register_prediction_api(server, models, default_model="Classical")
+
+# Tiles of the images shown as a tile pyramid
+from components.image.pyramid import register_tile_route
+register_tile_route(server)
+
 # Testing server, don't use in production, host
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8050, debug=True)
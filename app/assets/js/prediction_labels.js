@@ -0,0 +1,60 @@
+// Clientside rendering of the patch probabilities of the prediction canvas.
+// All the labels are drawn as a single text trace, thinned to about MAX_LABELS for the current zoom,
+// so zooming in shows more of them without a request to the server.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    prediction: {
+        MAX_LABELS: 150,
+
+        render_labels: function(data, relayout_data) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+            const triggered = window.dash_clientside.callback_context.triggered.map(t => t.prop_id);
+            const labels = data.labels;
+            // a new prediction is drawn unzoomed, the range of the last zoom belongs to the previous figure
+            const relayout = triggered.length > 0 && triggered.every(id => id.endsWith('.relayoutData'));
+            const zoomed = relayout && relayout_data && ('xaxis.range[0]' in relayout_data || 'xaxis.range' in relayout_data);
+            const reset = relayout && relayout_data && ('xaxis.autorange' in relayout_data);
+            if (relayout && (!labels || !(zoomed || reset))) {
+                return window.dash_clientside.no_update;
+            }
+            const figure = {data: data.figure.data.slice(), layout: data.figure.layout};
+            if (!labels || labels.x.length === 0) {
+                return figure;
+            }
+
+            // visible area, the whole figure unless this update is a zoom
+            let x_range = [-Infinity, Infinity];
+            let y_range = [-Infinity, Infinity];
+            if (zoomed && !reset) {
+                x_range = relayout_data['xaxis.range'] || [relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']];
+                y_range = relayout_data['yaxis.range'] || [relayout_data['yaxis.range[0]'], relayout_data['yaxis.range[1]']];
+                x_range = [Math.min(...x_range), Math.max(...x_range)];
+                y_range = [Math.min(...y_range), Math.max(...y_range)];
+            }
+            const visible = [];
+            for (let i = 0; i < labels.x.length; i++) {
+                if (labels.x[i] >= x_range[0] && labels.x[i] <= x_range[1] &&
+                    labels.y[i] >= y_range[0] && labels.y[i] <= y_range[1]) {
+                    visible.push(i);
+                }
+            }
+            // every step-th row and column of the patch grid
+            const step = Math.max(1, Math.ceil(Math.sqrt(visible.length / window.dash_clientside.prediction.MAX_LABELS)));
+            const shown = visible.filter(i => labels.row[i] % step === 0 && labels.col[i] % step === 0);
+            figure.data.push({
+                type: 'scatter',
+                mode: 'markers+text',
+                x: shown.map(i => labels.x[i]),
+                y: shown.map(i => labels.y[i]),
+                text: shown.map(i => labels.text[i]),
+                textfont: {family: 'Courier New, monospace', size: 14, color: '#ffffff'},
+                marker: {symbol: 'square', size: 36, color: '#000000', opacity: 0.6,
+                         line: {color: '#ffffff', width: 1}},
+                hoverinfo: 'skip',
+                showlegend: false
+            });
+            return figure;
+        }
+    }
+});
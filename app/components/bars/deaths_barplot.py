@@ -5,6 +5,10 @@ from dash import dcc, html
 import pandas as pd
 import plotly.express as px
 
+from components.data.deaths_cube import DeathsCube
+from components.data.bitmap_index import BitmapIndex
+from components.data.figure_cache import FigureCache, normalize_categories
+
 
 class BarPlot:
     """Represent cancer deaths information using Barplots"""        
@@ -16,7 +20,9 @@ class BarPlot:
         register_column: str = "Numero_Registros",
         labels: dict = {"Numero_Registros" : "Número de muertes", "Causa" : "Tipo de cancer"},
         title: str = "Numero de muertes por tipo de Cancer",
-        allowed_columns : list = ['Causa', 'Sexo', 'Edad', 'Educacion', 'Etnia', 'Area_Residencia', 'Seguridad_social',]
+        allowed_columns : list = ['Causa', 'Sexo', 'Edad', 'Educacion', 'Etnia', 'Area_Residencia', 'Seguridad_social',],
+        cube: DeathsCube = None,
+        index: BitmapIndex = None,
         ):
         """Constructs a Barplot to visualize cancer deaths data
         Args:
@@ -26,6 +32,8 @@ class BarPlot:
             second_variable (str, optional): Second variable to use. Defaults to 'Sexo'.
             labels (str, optional): Rename labels
             title (str, optional): Rename the title of this component.
+            cube (DeathsCube, optional): Pre-aggregated data, shared with other components. Defaults to one built from data.
+            index (BitmapIndex, optional): Index of the cube, gives the categories of the variables. Defaults to one built from cube.
         """
         self.id = id
         self.data = data
@@ -37,6 +45,10 @@ class BarPlot:
         self.allowed_columns = allowed_columns
         self.first_variable_categories = []
         self.second_variable_categories = []
+        self.cube = cube if cube is not None else DeathsCube(data, measure = register_column)
+        self.index = index if index is not None else BitmapIndex(self.cube)
+        # figures of the filter states already shown
+        self.figure_cache = FigureCache()
 
     # Define id names
     def first_variable_id(self):
@@ -55,41 +67,63 @@ class BarPlot:
         return self.id + "_figure"
 
     def obtainCategories(self, category):
-        #just keep the first 15 
-        categories = self.data[category].dropna().unique()
+        # sorted, without nan values, precomputed by the index
+        if category in self.index.categories:
+            return self.index.categories[category]
+        categories = np.asarray(self.data[category].dropna().unique())
         categories.sort()
         return categories
 
 
-    def update_figure(self):
+    def set_data(self, data: pd.DataFrame, cube: DeathsCube = None, index: BitmapIndex = None):
+        """Replace the death data information, e.g. when the dataset is reloaded"""
+        self.data = data
+        self.cube = cube if cube is not None else DeathsCube(data, measure = self.register_column)
+        self.index = index if index is not None else BitmapIndex(self.cube)
+        self.figure_cache.clear()
+
+    def update_figure(self, first_variable = None, first_variable_categories = None,
+        second_variable = None, second_variable_categories = None):
+        """
+            Return the Barplot of the First and Second Variables and their categories (the ones of
+            this component when not given), reusing the figure if the same filters were already shown.
+            The component is not modified, so the requests of different users can share it.
+        """
+        first_variable = self.first_variable if first_variable is None else first_variable
+        second_variable = self.second_variable if second_variable is None else second_variable
+        if first_variable_categories is None:
+            first_variable_categories = self.first_variable_categories
+        if second_variable_categories is None:
+            second_variable_categories = self.second_variable_categories
+        if first_variable not in self.allowed_columns:
+            first_variable = self.allowed_columns[0]
+        if second_variable not in self.allowed_columns:
+            second_variable = self.allowed_columns[1]
+
+        key = (first_variable, normalize_categories(first_variable_categories),
+            second_variable, normalize_categories(second_variable_categories))
+        return self.figure_cache.get(key, self.build_figure)
+
+    def build_figure(self, first_variable, first_variable_categories, second_variable, second_variable_categories):
         """
             Filter the data given the First and Second Variables.
             Generate the Barplot given this information.
         """
-        if self.first_variable == None or self.first_variable not in self.allowed_columns:
-            self.first_variable = self.allowed_columns[0]
-        if self.second_variable == None or self.second_variable not in self.allowed_columns:
-            self.second_variable = self.allowed_columns[1]
-
         deaths = None
-        if self.first_variable == self.second_variable:
-            deaths = self.data.groupby([self.first_variable])[self.register_column].sum().reset_index()
+        filters = [(first_variable, first_variable_categories), (second_variable, second_variable_categories)]
+        if first_variable == second_variable:
+            deaths = self.cube.query([first_variable], filters)
         else : 
-            deaths = self.data.groupby([self.first_variable, self.second_variable])[self.register_column].sum().reset_index()
-
-        if len(self.first_variable_categories) > 0:
-            deaths = deaths[deaths[self.first_variable].isin(self.first_variable_categories)]
-        if len(self.second_variable_categories) > 0:
-            deaths = deaths[deaths[self.second_variable].isin(self.second_variable_categories)]
+            deaths = self.cube.query([first_variable, second_variable], filters)
 
-        if self.first_variable == self.second_variable:
+        if first_variable == second_variable:
             deaths = deaths.sort_values(self.register_column, ascending = True)
-            fig = px.bar(deaths, y=self.first_variable, x=self.register_column, barmode = 'group',
+            fig = px.bar(deaths, y=first_variable, x=self.register_column, barmode = 'group',
                 labels = self.labels, height = 600, text_auto=True, template="simple_white",
                 color_discrete_sequence=px.colors.qualitative.Vivid,) 
         else :    
-            deaths = deaths.sort_values(self.first_variable, ascending = True)
-            fig = px.bar(deaths, y=self.first_variable, x=self.register_column, color = self.second_variable, 
+            deaths = deaths.sort_values(first_variable, ascending = True)
+            fig = px.bar(deaths, y=first_variable, x=self.register_column, color = second_variable, 
                 barmode = 'group', labels = self.labels, height = 600, text_auto=True, template="simple_white",
                 color_discrete_sequence=px.colors.qualitative.Vivid,) 
 
@@ -100,8 +134,8 @@ class BarPlot:
         """Render this component
         """
         fig = self.update_figure()
-        self.first_variable_categories = self.obtainCategories(self.first_variable)
-        self.second_variable_categories = self.obtainCategories(self.second_variable)
+        first_variable_categories = self.obtainCategories(self.first_variable)
+        second_variable_categories = self.obtainCategories(self.second_variable)
 
         controls = dbc.Card(
             [
@@ -125,7 +159,7 @@ class BarPlot:
                         dcc.Dropdown(
                             id=self.first_variable_categories_id(),
                             options=[
-                                {"label": col[:15], "value": col} for col in self.first_variable_categories
+                                {"label": col[:15], "value": col} for col in first_variable_categories
                             ],
                             value = [],
                             multi=True,
@@ -154,7 +188,7 @@ class BarPlot:
                         dcc.Dropdown(
                             id=self.second_variable_categories_id(),
                             options=[
-                                {"label": col[:15], "value": col} for col in self.second_variable_categories
+                                {"label": col[:15], "value": col} for col in second_variable_categories
                             ],
                             value=[],
                             multi=True,
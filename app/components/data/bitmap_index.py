@@ -0,0 +1,64 @@
+"""Bitmap index of the cells of a DeathsCube.
+Every category of the filter columns has a packed bitmap of the cells it appears in, so a filter is
+an OR of bitmaps within each column and an AND across columns, on 8 cells per byte.
+The sorted categories of every column are kept too, they are the options of the dropdowns.
+"""
+import numpy as np
+
+from components.data.deaths_cube import DeathsCube
+
+
+FILTER_COLUMNS = ['Causa', 'Sexo', 'Edad', 'Educacion', 'Etnia', 'Area_Residencia', 'Seguridad_social']
+
+
+class BitmapIndex:
+    """Packed bitmaps of the cells of a cube for every (column, category)"""
+    def __init__(self, cube: DeathsCube, columns = FILTER_COLUMNS):
+        """
+        Args:
+            cube (DeathsCube): Pre-aggregated data to index.
+            columns (list, optional): Indexed columns. Defaults to FILTER_COLUMNS.
+        """
+        self.cube = cube
+        self.categories = dict()
+        self.positions = dict()
+        self.bitmaps = dict()
+        for column in columns:
+            codes = cube.codes[:, cube.dimensions.index(column)]
+            # categories that appear in the cells, sorted and without missing values
+            present = np.unique(codes[codes > 0])
+            self.categories[column] = cube.categories[column][present - 1]
+            self.positions[column] = {category : row for row, category in enumerate(self.categories[column])}
+            self.bitmaps[column] = np.packbits(codes[np.newaxis, :] == present[:, np.newaxis], axis=1)
+
+    def mask(self, filters):
+        """Packed bitmap of the cells whose columns are in the given categories or None if nothing
+        is filtered, filters are (column, categories) pairs and empty category lists do not filter"""
+        mask = None
+        for column, categories in filters:
+            if categories is None or len(categories) == 0:
+                continue
+            rows = [self.positions[column][category] for category in categories if category in self.positions[column]]
+            if rows:
+                column_mask = np.bitwise_or.reduce(self.bitmaps[column][rows], axis=0)
+            else:
+                column_mask = np.zeros(self.bitmaps[column].shape[1], dtype=np.uint8)
+            mask = column_mask if mask is None else np.bitwise_and(mask, column_mask, out=mask)
+        return mask
+
+    def sum_by(self, dimension, filters = ()):
+        """Sum of the measure of the filtered cells for every category of a cube dimension.
+        Returns the positions in cube.categories[dimension] of the categories with cells and their sums.
+        """
+        cube = self.cube
+        codes = cube.codes[:, cube.dimensions.index(dimension)]
+        values = cube.values
+        mask = self.mask(filters)
+        if mask is not None:
+            selected = np.unpackbits(mask, count=len(cube)).view(bool)
+            codes, values = codes[selected], values[selected]
+        size = len(cube.categories[dimension]) + 1
+        sums = np.bincount(codes, weights=values, minlength=size)
+        # missing values (code 0) are not a group
+        present = np.flatnonzero(np.bincount(codes, minlength=size)[1:])
+        return present, np.rint(sums[present + 1]).astype(values.dtype)
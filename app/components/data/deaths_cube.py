@@ -0,0 +1,85 @@
+"""Pre-aggregated number of deaths of the exploration page.
+The records are aggregated once into the cells of a cube: one cell per combination of the dimensions
+that exists in the data, with the sum of its deaths. Group bys and category filters of the plots are
+answered from the cells, so their cost depends on the number of cells instead of the number of records.
+"""
+import numpy as np
+import pandas as pd
+
+
+DIMENSIONS = ['Causa', 'Sexo', 'Edad', 'Educacion', 'Etnia', 'Area_Residencia', 'Seguridad_social',
+    'COD_DPTO', 'Departamento']
+
+
+def encode(column):
+    """Codes and sorted categories of a column, codes start at 1 and 0 is a missing value"""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy().astype(np.int32) + 1, np.asarray(column.cat.categories, dtype=object)
+    codes, categories = pd.factorize(column, sort=True)
+    return codes.astype(np.int32) + 1, np.asarray(categories, dtype=object)
+
+
+class DeathsCube:
+    """Sum of a measure over every existing combination of the dimensions"""
+    def __init__(self, data, dimensions = DIMENSIONS, measure = 'Numero_Registros'):
+        """
+        Args:
+            data (pd.DataFrame): Death data information, one row per record.
+            dimensions (list, optional): Columns that can be grouped or filtered by. Defaults to DIMENSIONS.
+            measure (str, optional): Column that is summed. Defaults to "Numero_Registros".
+        """
+        self.dimensions = list(dimensions)
+        self.measure = measure
+        self.categories = dict()
+        codes = np.empty((len(data), len(self.dimensions)), dtype=np.int32)
+        for index, dimension in enumerate(self.dimensions):
+            codes[:, index], self.categories[dimension] = encode(data[dimension])
+        values = data[measure].to_numpy()
+        # a cell per distinct row of codes
+        self.codes, inverse = np.unique(codes, axis=0, return_inverse=True)
+        self.values = np.zeros(len(self.codes), dtype=values.dtype)
+        np.add.at(self.values, inverse.ravel(), values)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def mask(self, filters):
+        """Cells whose dimensions are in the given categories, filters are (dimension, categories) pairs
+        and empty category lists do not filter"""
+        mask = np.ones(len(self.codes), dtype=bool)
+        for dimension, categories in filters:
+            if categories is None or len(categories) == 0:
+                continue
+            # selected[code] tells if a category is kept, missing values never are
+            selected = np.concatenate([[False], np.isin(self.categories[dimension], list(categories))])
+            mask &= selected[self.codes[:, self.dimensions.index(dimension)]]
+        return mask
+
+    def query(self, by, filters = ()):
+        """Sum of the measure grouped by some dimensions of the filtered cells, sorted by them.
+        Same as data[filters].groupby(by)[measure].sum().reset_index() on the records.
+        """
+        mask = self.mask(filters)
+        columns = [self.dimensions.index(dimension) for dimension in by]
+        keys = self.codes[mask][:, columns]
+        values = self.values[mask]
+        # missing values are not a group
+        present = (keys > 0).all(axis=1)
+        keys, values = keys[present], values[present]
+        groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+        sums = np.zeros(len(groups), dtype=self.values.dtype)
+        np.add.at(sums, inverse.ravel(), values)
+
+        result = {dimension : self.categories[dimension][groups[:, index] - 1] for index, dimension in enumerate(by)}
+        result[self.measure] = sums
+        return pd.DataFrame(result, columns=list(by) + [self.measure])
+
+    def related(self, dimension, other):
+        """Label of another dimension for every category of a dimension (e.g. the names of the codes),
+        taken from the first cell of the category"""
+        labels = np.full(len(self.categories[dimension]), None, dtype=object)
+        codes = self.codes[:, [self.dimensions.index(dimension), self.dimensions.index(other)]]
+        codes = codes[(codes > 0).all(axis=1)]
+        present, first = np.unique(codes[:, 0], return_index=True)
+        labels[present - 1] = self.categories[other][codes[first, 1] - 1]
+        return labels
@@ -0,0 +1,113 @@
+"""Deaths dataset of the exploration page (assets/csv/muertes2020.csv).
+Parsing the csv and renaming the cancer causes takes most of the startup of the page, so the cleaned
+dataset is cached as a parquet file, with the filter columns stored as categoricals (a small code per
+row instead of a python string, which also makes filters and group bys faster).
+Build step, run from the app folder after updating the csv:
+    python -m components.data.deaths_data
+Without the parquet file (or pyarrow), or if it is older than the csv, the csv is read instead.
+"""
+import argparse
+import os
+from pathlib import Path
+
+import pandas as pd
+
+
+app_path = Path(os.path.dirname(os.path.realpath(__file__))).parent.parent.absolute()
+CSV_PATH = os.path.join(app_path, 'assets', 'csv', 'muertes2020.csv')
+CACHE_PATH = os.path.join(app_path, 'assets', 'csv', 'muertes2020.parquet')
+
+CATEGORICAL_COLUMNS = ['Causa', 'Sexo', 'Edad', 'Educacion', 'Etnia', 'Area_Residencia', 'Seguridad_social']
+
+# Short names of the cancer causes
+CANCER_LABELS_MAP = {
+    'Tumor maligno de la mama de la mujer' : 'Seno',
+    'Tumor maligno de la próstata': 'Próstata', 
+    'Tumor maligno del estómago ' : 'Estómago',
+    'Tumor maligno de la tráquea, los bronquios y el pulmón ' : 'Traquea, Bronquios, Pulmón',
+    'Tumor maligno del colon, de la unión rectosigmoidea, recto y ano' : 'Colon, Recto, Ano',
+    'Tumor maligno del cuello del útero ' : 'Cuello del útero',
+    'Todos los demás tumores malignos del tejido linfático, de los órganos hematopoyéticos y de tejidos afines ' : 'T. Linfático, O. hematopoyéticos, T. Afines',
+    'Tumor maligno del ovario ' : 'Ovario', 
+    'Tumor maligno del páncreas ' : 'Páncreas',
+    'Tumor maligno del hígado ' : 'Hígado',
+    'Tumor maligno de sitios no especificados' : 'Sitios no especificados',
+    'Tumor maligno del encéfalo, del ojo y de otras partes del sistema nervioso central ': 'Encéfalo, Ojo, S. Nervioso Central',
+    'Tumor maligno de la vesícula biliar y de las vías biliares ' : 'Vesícula biliar',
+    'Tumor maligno de otras partes del útero' : 'Otras parter útero',
+    'Todos los demás tumores malignos de otras localizaciones ' : 'Otras localizaciones',
+    'Tumor maligno del esófago' : 'Esófago',
+    'Tumores malignos del labio, de la cavidad bucal y de la faringe ': 'Labio, Cavidad Bucal, Faringe',
+    'Melanoma y otros tumores malignos de la piel' : 'Melanoma, Piel',
+    'Todos los demás tumores malignos de los órganos urinarios' : 'O. Urinarios',
+    'Tumor maligno de la vejiga urinaria ': 'Vejiga urinaria',
+    'Tumor maligno del tiroides y de otras glandulas endocrinas ' : 'Tiroides, Glandulas Endocrinas',
+    'Tumor maligno de la laringe ' : 'Laringe',
+    'Todos los demás tumores malignos de los órganos digestivos y del peritoneo ' : 'O. Digestivos y Peritoneo',
+    'Tumores malignos de sitios mal definidos y secundarios ' : 'Sitios mal definidos, Secundarios',
+    'Tumor maligno de los huesos y de los cartilagos articulares': 'Huesos, Cartilagos articulares',
+    'Todos los demás tumores malignos de los órganos respiratorios e intratorácicos, excepto tráquea, bronquios y pulmón ' : 'Otros Respiratorios'
+}
+
+
+def to_categorical(data):
+    return data.astype({column : 'category' for column in CATEGORICAL_COLUMNS if column in data.columns})
+
+
+def read_csv(path = CSV_PATH):
+    """Cleaned dataset from the csv: cancer causes renamed and filter columns as categoricals"""
+    data = pd.read_csv( path, sep=',', encoding='ISO-8859-1',
+                       dtype= {
+                           'COD_DPTO' : str,
+                           'COD_MUNIC' : str
+                        }) .drop(columns='Unnamed: 0')
+
+    #Rename cancer categories
+    cancer_cats = [cat for cat in data['Causa'].unique()
+                   if 'tumor' in cat.lower() and 'maligno' in cat.lower()]
+    mask = data['Causa'].isin(cancer_cats)
+    data.loc[mask, 'Causa'] = data.loc[mask, 'Causa'].map(CANCER_LABELS_MAP)
+    return to_categorical(data)
+
+
+def load_deaths_data(csv_path = CSV_PATH, cache_path = CACHE_PATH):
+    """Cleaned dataset, from the parquet cache when it is up to date"""
+    if os.path.exists(cache_path) and (not os.path.exists(csv_path) or
+            os.path.getmtime(cache_path) >= os.path.getmtime(csv_path)):
+        try:
+            return pd.read_parquet(cache_path)
+        except ImportError:
+            # no parquet engine installed
+            pass
+    return read_csv(csv_path)
+
+
+def cancer_deaths(data):
+    """Rows of the cancer causes, the categories of the other causes are dropped"""
+    cancer_data = data[data['Causa'].isin(CANCER_LABELS_MAP.values())]
+    return cancer_data.assign(**{
+        column : cancer_data[column].cat.remove_unused_categories()
+        for column in CATEGORICAL_COLUMNS if isinstance(cancer_data[column].dtype, pd.CategoricalDtype)
+    })
+
+
+def build_cache(csv_path = CSV_PATH, cache_path = CACHE_PATH):
+    """Write the cleaned dataset of the csv as parquet, returns the written path"""
+    data = read_csv(csv_path)
+    # write to a temporary file first, so other workers never read a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    data.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cache the cleaned deaths dataset as parquet")
+    parser.add_argument('--csv', default=CSV_PATH)
+    parser.add_argument('--output', default=CACHE_PATH)
+    args = parser.parse_args()
+    print(args.csv, '->', build_cache(args.csv, args.output))
+
+
+if __name__ == "__main__":
+    main()
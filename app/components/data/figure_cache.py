@@ -0,0 +1,56 @@
+import json
+import threading
+from collections import OrderedDict
+
+
+def normalize_categories(categories):
+    """Hashable form of a category filter, the order and repetitions of the categories do not matter"""
+    if categories is None:
+        return ()
+    return tuple(sorted(set(categories)))
+
+
+class FigureCache:
+    """Least recently used cache of the figures of a component, keyed by its filter state.
+    Figures are stored as JSON, a hit returns them without filtering the data or running plotly express.
+    The cache lives in the worker, like the dataset it depends on.
+    """
+    def __init__(self, max_entries = 64):
+        """
+        Args:
+            max_entries (int, optional): Max number of stored figures. Defaults to 64.
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """Return the figure (as a dict) stored under key, build(*key) makes it when it is not stored.
+        The figure is built from the key alone, so what is stored under a key is always the figure it describes.
+        """
+        with self.lock:
+            figure = self.entries.get(key)
+            if figure is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if figure is None:
+            figure = build(*key).to_json()
+            with self.lock:
+                self.entries[key] = figure
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return json.loads(figure)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+    def clear(self):
+        """Drop every figure, e.g. when the dataset is reloaded"""
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,57 @@
+"""Population of the departments, for the death rates of the exploration page.
+The populations are kept in a dense array indexed by the numeric department code (DIVIPOLA),
+so the population of any set of departments is a single gather instead of a merge.
+"""
+import numpy as np
+import pandas as pd
+
+
+TOTAL, MEN, WOMEN = 0, 1, 2
+# columns of the projections csv of each kind of population
+POPULATION_COLUMNS = ['Total', 'Total Hombres', 'Total Mujeres']
+# names of the columns added by PopulationLookup.add_to
+POPULATION_NAMES = ['Poblacion', 'Poblacion Hombres', 'Poblacion Mujeres']
+
+
+def department_numbers(codes):
+    """Numeric department codes ('05' -> 5), -1 for missing or non numeric codes"""
+    numbers = pd.to_numeric(pd.Series(np.asarray(codes, dtype=object)), errors='coerce')
+    return numbers.fillna(-1).astype(np.int64).to_numpy()
+
+
+class PopulationLookup:
+    """Total, men and women population of every department, indexed by department code"""
+    def __init__(self, population_data: pd.DataFrame, code_column = 'DP', columns = POPULATION_COLUMNS):
+        """
+        Args:
+            population_data (pd.DataFrame): One row per department with its code and populations.
+            code_column (str, optional): Column of the department codes. Defaults to 'DP'.
+            columns (list, optional): Columns of the total, men and women populations. Defaults to POPULATION_COLUMNS.
+        """
+        numbers = department_numbers(population_data[code_column])
+        valid = numbers >= 0
+        size = max(100, int(numbers.max()) + 1 if valid.any() else 0)
+        self.table = np.zeros((size, len(columns)), dtype=np.int64)
+        self.known = np.zeros(size, dtype=bool)
+        self.table[numbers[valid]] = population_data[columns].to_numpy()[valid]
+        self.known[numbers[valid]] = True
+
+    def gather(self, numbers):
+        """(populations, known) of numeric department codes, populations is (n, 3) as TOTAL, MEN, WOMEN"""
+        numbers = np.asarray(numbers)
+        known = (numbers >= 0) & (numbers < len(self.known))
+        known[known] = self.known[numbers[known]]
+        populations = np.zeros((len(numbers), self.table.shape[1]), dtype=self.table.dtype)
+        populations[known] = self.table[numbers[known]]
+        return populations, known
+
+    def add_to(self, data: pd.DataFrame, code_column = 'COD_DPTO'):
+        """data with the populations of its departments (POPULATION_NAMES columns),
+        rows of departments without population are dropped"""
+        populations, known = self.gather(department_numbers(data[code_column]))
+        data = data[known].reset_index(drop = True)
+        return data.assign(**{
+            POPULATION_NAMES[MEN] : populations[known, MEN],
+            POPULATION_NAMES[WOMEN] : populations[known, WOMEN],
+            POPULATION_NAMES[TOTAL] : populations[known, TOTAL],
+        })
@@ -6,6 +6,11 @@ import pandas as pd
 import plotly.express as px
 import numpy as np
 
+from components.data.deaths_cube import DeathsCube
+from components.data.bitmap_index import BitmapIndex
+from components.data.population import PopulationLookup, department_numbers, TOTAL, MEN, WOMEN
+from components.data.figure_cache import FigureCache, normalize_categories
+
 class GeoPlot:
     """Represent cancer deaths information using a map with Colombian Departments"""        
     def __init__(self, 
@@ -14,12 +19,25 @@ class GeoPlot:
         geojson,
         id: str,
         filter_by_column : list = {'Causa' : [], 'Sexo': [], 'Edad': [], 'Educacion': [], 'Etnia': [], 'Area_Residencia': [], 'Seguridad_social': []},
+        cube: DeathsCube = None,
+        index: BitmapIndex = None,
+        population_by_sex : dict = {'Masculino' : MEN, 'Femenino' : WOMEN},
         ):
         self.id = id
         self.data = data
         self.population_data = population_data
+        self.population = PopulationLookup(population_data)
+        # when only these sexes are selected the rates are relative to their population
+        self.population_by_sex = population_by_sex
         self.geojson = geojson
         self.filter_by_column = filter_by_column
+        # pre-aggregated data, shared with other components
+        self.cube = cube if cube is not None else DeathsCube(data)
+        self.index = index if index is not None else BitmapIndex(self.cube)
+        self.department_names = self.cube.related('COD_DPTO', 'Departamento')
+        self.department_numbers = department_numbers(self.cube.categories['COD_DPTO'])
+        # figures of the filter states already shown
+        self.figure_cache = FigureCache()
 
     # Define id names
     def variable_id(self, column):
@@ -33,50 +51,75 @@ class GeoPlot:
 
 
     def obtainCategories(self, category):
-        #drop nan values
-        categories = self.data[category].dropna().unique()
+        # sorted, without nan values, precomputed by the index
+        if category in self.index.categories:
+            return self.index.categories[category]
+        categories = np.asarray(self.data[category].dropna().unique())
         categories.sort()
         return categories
 
 
 
     def addPopulationInformation(self, data):
-        data = data.merge(self.population_data, 
-                                        left_on = ['COD_DPTO'], 
-                                        right_on = ['DP'])
-        data = data.drop(columns=['DP', 'DPNOM'])
-        data = data.reset_index(drop = True) 
-        data = data.rename(columns = {'Total' : 'Poblacion', 
-                                    'Total Hombres' : 'Poblacion Hombres', 
-                                    'Total Mujeres' : 'Poblacion Mujeres'
-                                    })
-        return data    
-
-
-    def filter_column(self, data, column,categories = []):
-        filtered_data = data
-        #apply filter
-        if len(categories) > 0:
-            filtered_data = filtered_data[filtered_data[column].isin(categories)]
-        return filtered_data
-
-    def apply_filter(self):
-        filtered_data = self.data
-        for column, categories in self.filter_by_column.items():
-            filtered_data = self.filter_column(filtered_data, column, categories)
-        department_data = filtered_data.groupby(['COD_DPTO', 'Departamento'])['Numero_Registros'].sum().reset_index()    
-        department_data = self.addPopulationInformation(department_data)
-        department_data['Tasa_muerte'] = np.round(department_data['Numero_Registros'] / department_data['Poblacion'] * 10000, 4)
+        return self.population.add_to(data)
+
+
+    def population_kinds(self, filter_by_column):
+        """Populations (TOTAL, MEN or WOMEN) the rates are relative to, given the sex filter"""
+        sexes = filter_by_column.get('Sexo')
+        if sexes is None or len(sexes) == 0 or any(sex not in self.population_by_sex for sex in sexes):
+            return [TOTAL]
+        return sorted({self.population_by_sex[sex] for sex in sexes})
+
+    def apply_filter(self, filter_by_column = None):
+        filter_by_column = self.filter_by_column if filter_by_column is None else filter_by_column
+        departments, deaths = self.index.sum_by('COD_DPTO', filter_by_column.items())
+        # departments without population are left out
+        populations, known = self.population.gather(self.department_numbers[departments])
+        departments, deaths, populations = departments[known], deaths[known], populations[known]
+        denominator = populations[:, self.population_kinds(filter_by_column)].sum(axis=1)
+        department_data = pd.DataFrame({
+            'COD_DPTO' : self.cube.categories['COD_DPTO'][departments],
+            'Departamento' : self.department_names[departments],
+            'Numero_Registros' : deaths,
+            'Poblacion Hombres' : populations[:, MEN],
+            'Poblacion Mujeres' : populations[:, WOMEN],
+            'Poblacion' : denominator,
+            'Tasa_muerte' : np.round(deaths / denominator * 10000, 4),
+        })
         return department_data
 
 
-    def update_figure(self):
+    def set_data(self, data: pd.DataFrame, population_data: pd.DataFrame = None, cube: DeathsCube = None,
+        index: BitmapIndex = None):
+        """Replace the death (and population) data information, e.g. when the dataset is reloaded"""
+        self.data = data
+        if population_data is not None:
+            self.population_data = population_data
+            self.population = PopulationLookup(population_data)
+        self.cube = cube if cube is not None else DeathsCube(data)
+        self.index = index if index is not None else BitmapIndex(self.cube)
+        self.department_names = self.cube.related('COD_DPTO', 'Departamento')
+        self.department_numbers = department_numbers(self.cube.categories['COD_DPTO'])
+        self.figure_cache.clear()
+
+    def update_figure(self, filter_by_column = None):
+        """
+            Return the map of the given categories of each column (the filters of this component for the
+            columns not given), reusing the figure if the same filters were already shown.
+            The component is not modified, so the requests of different users can share it.
+        """
+        filter_by_column = dict(self.filter_by_column, **(filter_by_column or {}))
+        filters = tuple((column, normalize_categories(categories)) for column, categories in filter_by_column.items())
+        return self.figure_cache.get((filters,), self.build_figure)
+
+    def build_figure(self, filters):
         """
-            Filter the data given the First and Second Variables.
-            Generate the Barplot given this information.
+            Filter the data given the (column, categories) pairs of filters.
+            Generate the map given this information.
         """
         #apply filter
-        deparment_data = self.apply_filter()
+        deparment_data = self.apply_filter(dict(filters))
         fig = px.choropleth_mapbox(deparment_data,        
                 locations='COD_DPTO',                      
                 color='Tasa_muerte',                      
@@ -95,7 +138,7 @@ class GeoPlot:
                 "Departamento=%{customdata[0]}",
                 "Tasa muerte=%{z}",
                 "Total muertes=%{customdata[1]}",
-                "Total poblacion=%{customdata[2]}",
+                "Poblacion=%{customdata[2]}",
             ])
         )
 
@@ -0,0 +1,184 @@
+"""Simplified department boundaries for the choropleth of the exploration page.
+Coordinates are rounded to a grid and the boundaries are simplified with Douglas-Peucker. Borders shared
+by two departments are split at their junctions and simplified once, so neighbours keep the same
+border and no gaps or overlaps appear. Only the DPTO and NOMBRE_DPT properties are kept.
+Build step, run from the app folder:
+    python -m components.geo.geometry --tolerance 0.005 --decimals 4
+The figures reference the file by its URL (geojson_url), the browser downloads it once
+and every later figure only carries the values of the departments.
+"""
+import argparse
+import json
+import os
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+
+app_path = Path(os.path.dirname(os.path.realpath(__file__))).parent.parent.absolute()
+SOURCE_PATH = os.path.join(app_path, 'assets', 'geo', 'colombia.geo.json')
+SIMPLIFIED_PATH = os.path.join(app_path, 'assets', 'geo', 'colombia.simplified.geo.json')
+# paths of the files under the dash assets folder
+GEOJSON_ASSET = 'geo/colombia.geo.json'
+SIMPLIFIED_ASSET = 'geo/colombia.simplified.geo.json'
+
+KEPT_PROPERTIES = ('DPTO', 'NOMBRE_DPT')
+
+
+def geojson_url():
+    """URL of the simplified boundaries if they were built, of the original ones otherwise.
+    Built by dash, so it follows the requests_pathname_prefix and assets_url_path of the app
+    """
+    import dash
+    return dash.get_asset_url(SIMPLIFIED_ASSET if os.path.exists(SIMPLIFIED_PATH) else GEOJSON_ASSET)
+
+
+def polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+
+def quantize_ring(ring, decimals):
+    """Closed ring of rounded (x, y) tuples without repeated consecutive points"""
+    points = [(round(point[0], decimals), round(point[1], decimals)) for point in ring]
+    quantized = [points[0]] + [point for previous, point in zip(points, points[1:]) if point != previous]
+    if quantized[0] != quantized[-1]:
+        quantized.append(quantized[0])
+    return quantized
+
+
+def douglas_peucker(points, tolerance):
+    """Points of a line kept by Douglas-Peucker, the first and last are always kept"""
+    coordinates = np.asarray(points, dtype=np.float64)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = coordinates[end] - coordinates[start]
+        relative = coordinates[start + 1:end] - coordinates[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            # closed lines, distance to the start point
+            distances = np.hypot(relative[:, 0], relative[:, 1])
+        else:
+            distances = np.abs(segment[0] * relative[:, 1] - segment[1] * relative[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+class BoundarySimplifier:
+    """Topology preserving simplification of the rings of a set of polygons"""
+    def __init__(self, tolerance = 0.005):
+        """
+        Args:
+            tolerance (float, optional): Max distance (in degrees) between a simplified border and
+                the original one. Defaults to 0.005, about 500m.
+        """
+        self.tolerance = tolerance
+        self.arcs = dict()
+
+    def find_junctions(self, rings):
+        # points with more than two distinct neighbours are where borders meet or part
+        neighbours = defaultdict(set)
+        for ring in rings:
+            for a, b in zip(ring, ring[1:]):
+                neighbours[a].add(b)
+                neighbours[b].add(a)
+        self.junctions = {point for point, near in neighbours.items() if len(near) > 2}
+
+    def simplify_arc(self, arc):
+        # an arc is simplified once, in a canonical direction, for every ring that shares it
+        reverse = tuple(arc[::-1]) < tuple(arc)
+        key = tuple(arc[::-1]) if reverse else tuple(arc)
+        if key not in self.arcs:
+            self.arcs[key] = douglas_peucker(list(key), self.tolerance)
+        simplified = self.arcs[key]
+        return simplified[::-1] if reverse else simplified
+
+    def simplify_ring(self, ring):
+        """Simplified closed ring or None if it collapses"""
+        points = ring[:-1]
+        cuts = [index for index, point in enumerate(points) if point in self.junctions]
+        if cuts:
+            points = points[cuts[0]:] + points[:cuts[0]]
+            cuts = [index - cuts[0] for index in cuts]
+        else:
+            # rings without junctions start at a canonical point, so a ring shared as is is simplified the same
+            start = points.index(min(points))
+            points = points[start:] + points[:start]
+            cuts = [0]
+        points = points + [points[0]]
+        cuts = cuts + [len(points) - 1]
+
+        simplified = [points[0]]
+        for start, end in zip(cuts, cuts[1:]):
+            simplified += self.simplify_arc(points[start:end + 1])[1:]
+        if len(simplified) < 4:
+            return None
+        return simplified
+
+    def simplify(self, geojson, decimals = 4):
+        """Simplified copy of a FeatureCollection of Polygon and MultiPolygon features"""
+        features = [
+            [[quantize_ring(ring, decimals) for ring in polygon] for polygon in polygons(feature['geometry'])]
+            for feature in geojson['features']
+        ]
+        self.find_junctions([ring for feature in features for polygon in feature for ring in polygon])
+
+        simplified_features = []
+        for feature, quantized in zip(geojson['features'], features):
+            simplified = []
+            for polygon in quantized:
+                rings = [self.simplify_ring(ring) for ring in polygon]
+                # polygons whose exterior collapses and holes that collapse are dropped
+                if rings[0] is not None:
+                    simplified.append([rings[0]] + [ring for ring in rings[1:] if ring is not None])
+            if not simplified:
+                # too small for the tolerance, kept as is
+                simplified = quantized
+            coordinates = [[[list(point) for point in ring] for ring in polygon] for polygon in simplified]
+            simplified_features.append({
+                'type': 'Feature',
+                'properties': {name: feature['properties'][name] for name in KEPT_PROPERTIES if name in feature['properties']},
+                'geometry': {'type': 'Polygon', 'coordinates': coordinates[0]} if len(coordinates) == 1 else
+                    {'type': 'MultiPolygon', 'coordinates': coordinates},
+            })
+        return {'type': 'FeatureCollection', 'features': simplified_features}
+
+
+def build_simplified(source = SOURCE_PATH, output = SIMPLIFIED_PATH, tolerance = 0.005, decimals = 4):
+    """Write the simplified boundaries of a geojson file, returns the written path"""
+    with open(source) as file:
+        geojson = json.load(file)
+    simplified = BoundarySimplifier(tolerance).simplify(geojson, decimals)
+    # write to a temporary file first, so the server never sends a partial file
+    tmp_path = f"{output}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(simplified, file, separators=(',', ':'))
+    os.replace(tmp_path, output)
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simplify the department boundaries of the choropleth")
+    parser.add_argument('--source', default=SOURCE_PATH)
+    parser.add_argument('--output', default=SIMPLIFIED_PATH)
+    parser.add_argument('--tolerance', type=float, default=0.005)
+    parser.add_argument('--decimals', type=int, default=4)
+    args = parser.parse_args()
+    output = build_simplified(args.source, args.output, args.tolerance, args.decimals)
+    print(args.source, f"({os.path.getsize(args.source)} bytes) ->", output, f"({os.path.getsize(output)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
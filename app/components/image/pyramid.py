@@ -0,0 +1,307 @@
+"""Multi-resolution tile pyramid of large images.
+Level 0 is the full resolution image, every level halves the previous one until it fits in a single tile.
+Tiles are generated on first request and kept as JPEG files, so every worker of the host shares them.
+The tiles are served by the flask route registered with register_tile_route (see app.py):
+    /tiles/<identity>/<level>/<row>/<col>.jpg
+"""
+import hashlib
+import io
+import json
+import math
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+import numpy as np
+from flask import abort, send_file
+from PIL import Image
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# channels of the png color types
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def png_chunks(file):
+    """(type, data) of the chunks of a png file, read one at a time"""
+    if file.read(8) != PNG_SIGNATURE:
+        raise ValueError("not a png file")
+    while True:
+        header = file.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('!I4s', header)
+        data = file.read(size)
+        file.read(4)
+        yield kind, data
+        if kind == b'IEND':
+            return
+
+
+def png_chunk(kind, data):
+    return struct.pack('!I', len(data)) + kind + data + struct.pack('!I', zlib.crc32(kind + data))
+
+
+def read_png_strips(path, strip_rows = 256):
+    """(rows, W, 3) uint8 strips of a non interlaced 8 bits png, from top to bottom.
+    The image data is inflated incrementally and every strip is unfiltered by PIL as a small png
+    whose first row is the last row of the previous strip, so only one strip is decoded at a time.
+    """
+    with open(path, 'rb') as file:
+        chunks = png_chunks(file)
+        _, ihdr = next(chunks)
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack('!IIBBBBB', ihdr)
+        if bit_depth != 8 or interlace != 0:
+            raise NotImplementedError(f"{path}: only non interlaced 8 bits pngs are read by strips")
+        row_size = 1 + width * PNG_CHANNELS[color_type]
+        strip_size = strip_rows * row_size
+        # palette and transparency are needed to decode every strip
+        extra = b''
+        previous = None
+
+        def decode(raw):
+            nonlocal previous
+            rows = len(raw) // row_size
+            if previous is not None:
+                # filter type 0 (none), the first row of the strip is unfiltered against it
+                raw = b'\x00' + previous + raw
+            strip_ihdr = struct.pack('!IIBBBBB', width, len(raw) // row_size, 8, color_type, 0, 0, 0)
+            strip = Image.open(io.BytesIO(PNG_SIGNATURE + png_chunk(b'IHDR', strip_ihdr) + extra +
+                png_chunk(b'IDAT', zlib.compress(raw, 0)) + png_chunk(b'IEND', b'')))
+            strip.load()
+            previous = strip.tobytes()[-(row_size - 1):]
+            return np.asarray(strip.convert('RGB'))[-rows:]
+
+        decompressor = zlib.decompressobj()
+        pending = bytearray()
+        done = 0
+        for kind, data in chunks:
+            if kind in (b'PLTE', b'tRNS'):
+                extra += png_chunk(kind, data)
+            if kind != b'IDAT':
+                continue
+            while data:
+                pending += decompressor.decompress(data, strip_size)
+                data = decompressor.unconsumed_tail
+                while len(pending) >= strip_size and done < height:
+                    yield decode(bytes(pending[:strip_size]))
+                    del pending[:strip_size]
+                    done += strip_rows
+        pending += decompressor.flush()
+        rows = min(len(pending) // row_size, height - done)
+        if rows > 0:
+            yield decode(bytes(pending[:rows * row_size]))
+            done += rows
+        if done < height:
+            raise ValueError(f"{path}: truncated png, {done} of {height} rows")
+
+
+def decode_png(path, directory = None):
+    """Memory mapped pixels of a png, decoded by strips once to a .npy file of the temp dir"""
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'breast_cancer_decoded')
+    stat = os.stat(path)
+    key = f"{os.path.realpath(path)}-{stat.st_mtime_ns}-{stat.st_size}"
+    decoded_path = os.path.join(directory, hashlib.sha256(key.encode()).hexdigest()[:24] + '.npy')
+    if not os.path.exists(decoded_path):
+        os.makedirs(directory, exist_ok=True)
+        with open(path, 'rb') as file:
+            chunks = png_chunks(file)
+            _, ihdr = next(chunks)
+        width, height = struct.unpack('!II', ihdr[:8])
+        # other workers never read a partial file
+        tmp_path = f"{decoded_path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        pixels = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+        row = 0
+        for strip in read_png_strips(path):
+            pixels[row:row + len(strip)] = strip
+            row += len(strip)
+        pixels.flush()
+        del pixels
+        os.replace(tmp_path, decoded_path)
+    return np.load(decoded_path, mmap_mode='r')
+
+
+def open_source(path):
+    """Full resolution pixels of an image file.
+    tiff and npy files are memory mapped, pngs are decoded by strips to a memory mapped temporary file
+    (read_png_strips), so the memory used does not depend on the size of the image. Other formats, and
+    interlaced or 16 bits pngs, are decoded whole.
+    """
+    if path.lower().endswith(('.tif', '.tiff')):
+        import tifffile
+        try:
+            return tifffile.memmap(path, mode='r')
+        except ValueError:
+            # compressed or tiled tiffs can not be memory mapped, they are decoded to a temporary memory mapped file
+            return tifffile.imread(path, out='memmap')
+    if path.lower().endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if path.lower().endswith('.png'):
+        try:
+            return decode_png(path)
+        except NotImplementedError:
+            pass
+    return np.asarray(Image.open(path).convert('RGB'))
+
+
+class TilePyramid:
+    """Lazily generated tile pyramid of an image file or array"""
+    _opened = dict()
+    _opened_lock = threading.Lock()
+
+    def __init__(self, image, tile_size = 256, quality = 85, directory = None, identity = None):
+        """
+        Args:
+            image (str or array): Path of the image (png, jpg, tiff or npy) or (H, W, 3) array.
+            tile_size (int, optional): Side of the square tiles. Defaults to 256.
+            quality (int, optional): JPEG quality of the tiles. Defaults to 85.
+            directory (str, optional): Where tiles are stored. Defaults to a folder in the temp dir.
+            identity (str, optional): Name of the tile folder. Defaults to a hash of the file or the pixels.
+        """
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), 'breast_cancer_tiles')
+        self.tile_size = tile_size
+        self.quality = quality
+
+        if isinstance(image, str):
+            source_path = os.path.realpath(image)
+            if identity is None:
+                stat = os.stat(source_path)
+                key = f"{source_path}-{stat.st_mtime_ns}-{stat.st_size}-{tile_size}-{quality}"
+                identity = hashlib.sha256(key.encode()).hexdigest()[:24]
+            self.source = open_source(source_path)
+        else:
+            self.source = image
+            if identity is None:
+                image = np.ascontiguousarray(image)
+                digest = hashlib.sha256(str((image.shape, image.dtype.str, tile_size, quality)).encode())
+                digest.update(image.tobytes())
+                identity = digest.hexdigest()[:24]
+            source_path = None
+        self.identity = identity
+        self.directory = os.path.join(directory, identity)
+        os.makedirs(self.directory, exist_ok=True)
+
+        meta_path = os.path.join(self.directory, 'meta.json')
+        if not os.path.exists(meta_path):
+            if source_path is None:
+                # arrays are stored once, so workers that did not create the pyramid can open it
+                source_path = os.path.join(self.directory, 'source.npy')
+                self.atomic_write(source_path, lambda file: np.save(file, image))
+            meta = {'source': source_path, 'tile_size': tile_size, 'quality': quality}
+            self.atomic_write(meta_path, lambda file: file.write(json.dumps(meta).encode()))
+
+        self.height, self.width = self.source.shape[0], self.source.shape[1]
+        # the top level fits in a single tile
+        self.levels = max(0, math.ceil(math.log2(max(self.height, self.width) / tile_size))) + 1
+        with TilePyramid._opened_lock:
+            TilePyramid._opened[self.identity] = self
+
+    @classmethod
+    def open(cls, identity, directory = None):
+        """Return the pyramid of an identity, created by this or any other process of the host"""
+        identity = os.path.basename(identity)
+        with cls._opened_lock:
+            if identity in cls._opened:
+                return cls._opened[identity]
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), 'breast_cancer_tiles')
+        meta_path = os.path.join(directory, identity, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as file:
+            meta = json.load(file)
+        return cls(meta['source'], meta['tile_size'], meta['quality'], directory, identity)
+
+    def atomic_write(self, path, write):
+        # other workers never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            write(file)
+        os.replace(tmp_path, path)
+
+    def level_shape(self, level):
+        scale = 2 ** level
+        return math.ceil(self.height / scale), math.ceil(self.width / scale)
+
+    def grid_shape(self, level):
+        height, width = self.level_shape(level)
+        return math.ceil(height / self.tile_size), math.ceil(width / self.tile_size)
+
+    def tile_path(self, level, row, col):
+        return os.path.join(self.directory, str(level), f"{row}_{col}.jpg")
+
+    def tile_array(self, level, row, col):
+        """Pixels of a tile, generated from the source (level 0) or from the 4 tiles below it"""
+        T = self.tile_size
+        if level == 0:
+            tile = np.asarray(self.source[row * T:(row + 1) * T, col * T:(col + 1) * T])
+            if tile.ndim == 2:
+                tile = np.stack([tile] * 3, axis=-1)
+            tile = tile[:, :, :3]
+            if tile.dtype != np.uint8:
+                zmax = 1 if tile.max() <= 1.05 else 255
+                tile = np.clip(tile * (255.0 / zmax), 0, 255).astype(np.uint8)
+            return tile
+        height, width = self.level_shape(level - 1)
+        rows, cols = self.grid_shape(level - 1)
+        children = np.zeros((2 * T, 2 * T, 3), dtype=np.uint8)
+        for i in range(2):
+            for j in range(2):
+                if 2 * row + i < rows and 2 * col + j < cols:
+                    child = self.read_tile(level - 1, 2 * row + i, 2 * col + j)
+                    children[i * T:i * T + child.shape[0], j * T:j * T + child.shape[1]] = child
+        children = children[:min(2 * T, height - 2 * row * T), :min(2 * T, width - 2 * col * T)]
+        size = (math.ceil(children.shape[1] / 2), math.ceil(children.shape[0] / 2))
+        return np.asarray(Image.fromarray(children).resize(size, Image.BOX))
+
+    def read_tile(self, level, row, col):
+        path = self.get_tile(level, row, col)
+        return np.asarray(Image.open(path).convert('RGB'))
+
+    def get_tile(self, level, row, col):
+        """Return the JPEG file of a tile, generating it if it does not exist"""
+        path = self.tile_path(level, row, col)
+        if not os.path.exists(path):
+            tile = self.tile_array(level, row, col)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.atomic_write(path, lambda file: Image.fromarray(tile).save(file, format='JPEG', quality=self.quality))
+        return path
+
+    def level_for_view(self, x_range, y_range, viewport = (800, 800)):
+        """Coarsest level with at least one tile pixel per screen pixel for the given axes ranges"""
+        density = max(abs(x_range[1] - x_range[0]) / viewport[0], abs(y_range[1] - y_range[0]) / viewport[1])
+        if density <= 1:
+            return 0
+        return min(int(math.log2(density)), self.levels - 1)
+
+    def visible_tiles(self, level, x_range, y_range):
+        """(row, col) of the tiles of a level inside the given full resolution axes ranges"""
+        span = self.tile_size * 2 ** level
+        rows, cols = self.grid_shape(level)
+        x0, x1 = sorted(x_range)
+        y0, y1 = sorted(y_range)
+        col_range = range(max(0, int(x0 // span)), min(cols, int(x1 // span) + 1))
+        row_range = range(max(0, int(y0 // span)), min(rows, int(y1 // span) + 1))
+        return [(row, col) for row in row_range for col in col_range]
+
+    def tile_url(self, level, row, col, route = '/tiles'):
+        return f"{route}/{self.identity}/{level}/{row}/{col}.jpg"
+
+
+def register_tile_route(server, route = '/tiles'):
+    """Serve the tiles of every pyramid of the host on a flask server (e.g. app.server)"""
+    def tile(identity, level, row, col):
+        pyramid = TilePyramid.open(identity)
+        if pyramid is None or level >= pyramid.levels:
+            abort(404)
+        rows, cols = pyramid.grid_shape(level)
+        if row >= rows or col >= cols:
+            abort(404)
+        # tiles never change for an identity, browsers can keep them
+        return send_file(pyramid.get_tile(level, row, col), mimetype='image/jpeg', max_age=86400)
+
+    server.add_url_rule(f"{route}/<identity>/<int:level>/<int:row>/<int:col>.jpg", 'tile', tile)
@@ -5,68 +5,291 @@ from dash import dcc, html
 import pandas as pd
 import plotly.express as px
 import numpy as np
+import base64
+import io
+import json
+from PIL import Image
+
+from components.image.pyramid import TilePyramid
+
+
+def to_uint8(image):
+    """Scale an image to uint8 as px.imshow does: floats up to 1 are in [0, 1], else in [0, 255]"""
+    image = np.asarray(image)
+    if image.dtype == np.uint8:
+        return image
+    zmax = 1 if np.nanmax(image) <= 1.05 else 255
+    return np.clip(np.nan_to_num(image) * (255.0 / zmax), 0, 255).astype(np.uint8)
+
+
+def image_to_data_uri(image, encoding = 'jpg', quality = 85):
+    """Encode an image as a png or jpg data URI"""
+    buffer = io.BytesIO()
+    pil_image = Image.fromarray(to_uint8(image))
+    if encoding == 'png':
+        pil_image.save(buffer, format='PNG')
+        mime = 'image/png'
+    else:
+        pil_image.convert('RGB').save(buffer, format='JPEG', quality=quality)
+        mime = 'image/jpeg'
+    return f"data:{mime};base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+# serialized figures and tile pyramids of the images shown with a key, shared by every Visualizer of the process
+_base_figures = dict()
+_pyramids = dict()
+
 
 class Visualizer():
     """
     Define a rectangular region and return the ROI of a given image
     """
+    ENCODINGS = ('raw', 'png', 'jpg')
+    # url of the tile route (see pyramid.register_tile_route) and expected size in pixels of the figure
+    TILE_ROUTE = '/tiles'
+    VIEWPORT = (800, 800)
+
     def __init__(self, 
         image, 
         title,
         id: str,
-        interactive: bool = True
+        interactive: bool = True,
+        encoding: str = 'raw',
+        quality: int = 85,
+        preview_size: int = None,
+        tile_above: int = None,
+        key: str = None
         ):
+        """
+        Args:
+            encoding (str, optional): How the image is sent to the browser. 'raw' sends every pixel as
+                json numbers, 'png' and 'jpg' send a compressed image. Defaults to 'raw'.
+            quality (int, optional): JPEG quality of the 'jpg' encoding. Defaults to 85.
+            preview_size (int, optional): Max side of the compressed image, bigger images are downscaled.
+                The axes keep the pixels of the full resolution image, so get_roi is not affected. Defaults to None.
+            tile_above (int, optional): Images with a bigger side are shown as a tile pyramid, only the tiles of
+                the current zoom and view are fetched by the browser. TilePyramid images are always tiled. Defaults to None.
+            key (str, optional): Identifies the image, its figure is reused by update_image (see get_figure). Defaults to None.
+        """
+        if encoding not in self.ENCODINGS:
+            raise ValueError(f"encoding must be one of {self.ENCODINGS}")
         self.id = id
         self.title = title
         self.interactive = interactive
-        self.update_image(image)
+        self.encoding = encoding
+        self.quality = quality
+        self.preview_size = preview_size
+        self.tile_above = tile_above
+        self.update_image(image, key)
 
 
     def figure_id(self):
         return self.id + "_figure"
 
-    def update_image(self, image):
-        # Generate the initial Figure
-        self.image = image
-        self.figure = px.imshow(self.image)
-        self.figure.update_layout(dragmode="drawrect" if self.interactive else None, 
+    def get_image_trace(self, image):
+        """Compressed image trace, placed so one unit of the axes is one pixel of the full resolution image"""
+        height, width = image.shape[0], image.shape[1]
+        preview = image
+        if self.preview_size is not None and max(height, width) > self.preview_size:
+            scale = self.preview_size / max(height, width)
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            preview = np.asarray(Image.fromarray(to_uint8(image)).resize(size, Image.BILINEAR))
+        dx = width / preview.shape[1]
+        dy = height / preview.shape[0]
+        return go.Image(
+            source = image_to_data_uri(preview, self.encoding, self.quality),
+            # px.imshow puts the center of the pixel (0, 0) at the origin
+            x0 = (dx - 1) / 2, y0 = (dy - 1) / 2, dx = dx, dy = dy,
+            hoverinfo = 'x+y'
+        )
+
+    def get_pyramid(self, image, key = None):
+        """Tile pyramid of an image if it is shown tiled, else None. Pyramids of keyed images are reused"""
+        if isinstance(image, TilePyramid):
+            return image
+        if self.tile_above is None or max(np.shape(image)[:2]) <= self.tile_above:
+            return None
+        if key is None:
+            return TilePyramid(image, quality = self.quality)
+        if key not in _pyramids:
+            _pyramids[key] = TilePyramid(image, quality = self.quality)
+        return _pyramids[key]
+
+    def full_view(self, pyramid):
+        return [[-0.5, pyramid.width - 0.5], [-0.5, pyramid.height - 0.5]]
+
+    def get_tiled_figure(self, pyramid, view = None):
+        """Empty axes of the size of the full resolution image with the tiles of view (the whole image by default)
+        as layout images. view is a [x_range, y_range] pair in full resolution pixels.
+        """
+        width, height = pyramid.width, pyramid.height
+        figure = go.Figure(go.Scatter(
+            x = [-0.5, width - 0.5], y = [-0.5, height - 0.5], mode = 'markers',
+            marker = dict(opacity = 0), hoverinfo = 'skip', showlegend = False
+        ))
+        figure.update_xaxes(range=[-0.5, width - 0.5], constrain='domain')
+        figure.update_yaxes(range=[height - 0.5, -0.5], scaleanchor='x', constrain='domain')
+        # the view is kept while its tiles are replaced and reset when the image changes
+        figure.update_layout(uirevision=pyramid.identity)
+        x_range, y_range = self.full_view(pyramid) if view is None else view
+        self.set_tiles(figure, pyramid, x_range, y_range)
+        self.style_figure(figure)
+        return figure
+
+    def set_tiles(self, figure, pyramid, x_range, y_range):
+        """Show on the figure the tiles of the pyramid level that matches the zoom of the given view"""
+        level = pyramid.level_for_view(x_range, y_range, self.VIEWPORT)
+        span = pyramid.tile_size * 2 ** level
+        images = []
+        for row, col in pyramid.visible_tiles(level, x_range, y_range):
+            images.append(dict(
+                source = pyramid.tile_url(level, row, col, self.TILE_ROUTE),
+                xref = 'x', yref = 'y', x = col * span - 0.5, y = row * span - 0.5,
+                sizex = min(span, pyramid.width - col * span), sizey = min(span, pyramid.height - row * span),
+                xanchor = 'left', yanchor = 'top', sizing = 'stretch', layer = 'below'
+            ))
+        figure.update_layout(images=images)
+
+    def get_view(self, relayout_data, pyramid, view = None):
+        """[x_range, y_range] view of a tiled figure after a zoom or pan, view is the previous one.
+        Returns None if relayout_data does not change the view.
+        """
+        if not relayout_data:
+            return None
+        x_range, y_range = self.full_view(pyramid) if view is None else view
+        if relayout_data.get('xaxis.autorange') or relayout_data.get('yaxis.autorange'):
+            x_range, y_range = self.full_view(pyramid)
+        else:
+            if 'xaxis.range' in relayout_data:
+                x_range = list(relayout_data['xaxis.range'])
+            elif 'xaxis.range[0]' in relayout_data:
+                x_range = [relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']]
+            if 'yaxis.range' in relayout_data:
+                y_range = list(relayout_data['yaxis.range'])
+            elif 'yaxis.range[0]' in relayout_data:
+                y_range = [relayout_data['yaxis.range[0]'], relayout_data['yaxis.range[1]']]
+        new_view = [list(x_range), list(y_range)]
+        previous = self.full_view(pyramid) if view is None else [list(view[0]), list(view[1])]
+        return None if new_view == previous else new_view
+
+    def update_viewport(self, relayout_data):
+        """Replace the tiles of the current tiled figure by the ones of the view in relayout_data (zoom or pan).
+        Returns None if the figure is not tiled or the view did not change.
+        """
+        if self.pyramid is None:
+            return None
+        view = self.get_view(relayout_data, self.pyramid, self.view)
+        if view is None:
+            return None
+        self.view = view
+        self.figure = self.get_tiled_figure(self.pyramid, view)
+        return self.figure
+
+    def build_figure(self, image):
+        """Figure of an image that is not tiled, the state of the component is not changed"""
+        if self.encoding == 'raw':
+            figure = px.imshow(image)
+        else:
+            figure = go.Figure(self.get_image_trace(np.asarray(image)))
+            figure.update_xaxes(constrain='domain')
+            figure.update_yaxes(autorange='reversed', scaleanchor='x', constrain='domain')
+        self.style_figure(figure)
+        return figure
+
+    def style_figure(self, figure):
+        figure.update_layout(dragmode="drawrect" if self.interactive else None, 
                         #newshape=dict(opacity=0.45, fillcolor="#94e3b6"),
                         margin=dict(l=5, r=5, b=5, t=5),
                         paper_bgcolor='rgba(0,0,0,0)',
                         plot_bgcolor='rgba(0,0,0,0)'                        
                     )
 
-        self.figure.update_xaxes(showticklabels=False, showgrid=False,  zerolinecolor = 'rgba(0,0,0,0)')
-        self.figure.update_yaxes(showticklabels=False, showgrid=False,  zerolinecolor = 'rgba(0,0,0,0)')        
-        self.figure.update_layout({
+        figure.update_xaxes(showticklabels=False, showgrid=False,  zerolinecolor = 'rgba(0,0,0,0)')
+        figure.update_yaxes(showticklabels=False, showgrid=False,  zerolinecolor = 'rgba(0,0,0,0)')        
+        figure.update_layout({
         'plot_bgcolor': 'rgba(0, 0, 0, 0)',
         'paper_bgcolor': 'rgba(0, 0, 0, 0)',
         })
 
+    def get_config(self, tiled = False):
         if self.interactive:
-            self.config = {
+            config = {
                 "modeBarButtonsToAdd": [
                     "drawrect",
                     "eraseshape",
                 ]
             }
         else:
-            self.config = dict()
+            config = dict()
+        if tiled:
+            # tiled images are explored zooming with the wheel
+            config["scrollZoom"] = True
+        return config
+
+    def get_figure(self, key, image):
+        """Figure of the image identified by key, as a dict.
+        It is built once per key and rendering options (interactive flag, encoding...) and kept
+        serialized, so showing the same image again does not go through plotly express.
+        """
+        cache_key = (key, self.interactive, self.encoding, self.quality, self.preview_size)
+        if cache_key not in _base_figures:
+            _base_figures[cache_key] = self.build_figure(image).to_json()
+        return json.loads(_base_figures[cache_key])
+
+    def prebuild(self, images):
+        """Build the figures of a {key: image} catalog, e.g. the sample images when the app starts"""
+        for key, image in images.items():
+            self.get_figure(key, image)
+
+    def update_image(self, image, key = None):
+        """Show a new image. Images with a key reuse the figure built for that key (see get_figure)"""
+        # Generate the initial Figure
+        self.pyramid = self.get_pyramid(image, key)
+        self.view = None
+        self.image = image if self.pyramid is None else self.pyramid.source
+        if self.pyramid is not None:
+            self.figure = self.get_tiled_figure(self.pyramid)
+        elif key is not None:
+            self.figure = self.get_figure(key, self.image)
+        else:
+            self.figure = self.build_figure(self.image)
+        self.config = self.get_config(tiled = self.pyramid is not None)
         return self.figure
 
+    def keep_last_roi(self, figure, relayout_data):
+        """Return the figure (a dict or go.Figure) showing only the last ROI drawn in relayout_data"""
+        last = relayout_data["shapes"][-1]
+        relayout_data["shapes"] = [last]
+        if isinstance(figure, dict):
+            figure.setdefault('layout', dict())['shapes'] = [last]
+        else:
+            figure.update_layout(shapes = [last])
+        return figure
 
     def update_figure(self, relayout_data):
         if "shapes" in relayout_data:
             # keep only the last ROI
-            last = relayout_data["shapes"][-1]
-            relayout_data["shapes"] = [last]
-            self.figure = go.Figure(self.figure)
-            self.figure.update_shapes(last)     
+            self.figure = self.keep_last_roi(go.Figure(self.figure), relayout_data)
             return self.figure
         else:
             return self.figure
 
-    def get_roi(self, relayout_data):
+    def get_labels(self, annotations):
+        """Columns of the patch annotations ({'x', 'y', 'text'} dicts of a patch grid) for a single text trace:
+        x, y, text and the row and col of each label on the grid, used to thin them out at low zoom
+        (see assets/js/prediction_labels.js).
+        """
+        x = np.array([annotation['x'] for annotation in annotations])
+        y = np.array([annotation['y'] for annotation in annotations])
+        _, col = np.unique(x, return_inverse=True)
+        _, row = np.unique(y, return_inverse=True)
+        return {
+            'x': x.tolist(), 'y': y.tolist(), 'text': [annotation['text'] for annotation in annotations],
+            'row': row.tolist(), 'col': col.tolist(),
+        }
+
+    def get_roi_box(self, relayout_data):
+        """Return the (x0, y0, x1, y1) pixel box of the last drawn ROI or None"""
         if not self.interactive:
             return None
 
@@ -75,21 +298,33 @@ class Visualizer():
             last = relayout_data["shapes"][-1]
             relayout_data["shapes"] = [last]
             
-            # Return the ROI
             # Shape coordinates are floats, we need to convert to ints for slicing
             x0, y0 = int(last["x0"]), int(last["y0"])
             x1, y1 = int(last["x1"]), int(last["y1"])
             x0, x1 = min(x0,x1), max(x0,x1)
             y0, y1 = min(y0,y1), max(y0,y1)
-
-            try:
-                roi_img = self.image[y0:y1, x0:x1]
-                return roi_img
-            except:
-                return None
+            return x0, y0, x1, y1
         else:
             return None
 
+    def get_roi(self, relayout_data, image = None):
+        """Return the pixels of the last drawn ROI of image (the current image by default) or None"""
+        box = self.get_roi_box(relayout_data)
+        if box is None:
+            return None
+        if image is None:
+            image = self.image
+        elif isinstance(image, TilePyramid):
+            image = image.source
+
+        # Return the ROI
+        x0, y0, x1, y1 = box
+        try:
+            roi_img = image[y0:y1, x0:x1]
+            return roi_img
+        except:
+            return None
+
     #DEFINE LAYOUT
     #Helper functions
     def display(self):
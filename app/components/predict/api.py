@@ -0,0 +1,200 @@
+"""HTTP batch prediction API.
+POST /api/predict scores one or more images (or ROIs) and returns their patch probability grids.
+
+JSON body:
+    {"model": "Classical", "images": [{"data": "<base64 png/jpg>", "roi": [x0, y0, x1, y1]}, ...]}
+Binary body (Content-Type image/* or application/octet-stream), a single image:
+    /api/predict?model=Classical&roi=x0,y0,x1,y1
+
+The patches of all the images of a request, and of concurrent requests, are merged by a MicroBatcher
+before they reach the model. Bodies above max_content_length bytes and requests whose images have more
+than max_pixels pixels in total are rejected with 413, the endpoint is public.
+"""
+import base64
+import io
+import queue
+import threading
+import time
+
+import numpy as np
+from flask import jsonify, request
+from PIL import Image
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+class MicroBatcher:
+    """Merge the patches of concurrent requests into large batches.
+    A batch is sent to the model when it has max_batch_size patches or when its first
+    request has waited max_wait seconds.
+    """
+    def __init__(self, model, max_batch_size = 256, max_wait = 0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        # the worker thread is started lazily, so it also runs on forked (gunicorn) workers
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def submit(self, patches):
+        """Queue a (N, PH, PW, C) array of patches, returns the job to wait for"""
+        self.start()
+        job = {'patches': patches, 'done': threading.Event(), 'result': None, 'error': None}
+        self.requests.put(job)
+        return job
+
+    def wait(self, job):
+        """Return the probabilities of a submitted job, blocks until they are predicted"""
+        job['done'].wait()
+        if job['error'] is not None:
+            raise job['error']
+        return job['result']
+
+    def predict(self, patches):
+        """Return the probabilities of a (N, PH, PW, C) array of patches, blocks until they are predicted"""
+        return self.wait(self.submit(patches))
+
+    def collect(self):
+        jobs = [self.requests.get()]
+        size = len(jobs[0]['patches'])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            jobs.append(job)
+            size += len(job['patches'])
+        return jobs
+
+    def run(self):
+        while True:
+            jobs = self.collect()
+            try:
+                patches = np.concatenate([job['patches'] for job in jobs])
+                probs = np.empty(len(patches), dtype=np.float32)
+                for start in range(0, len(patches), self.model.batch_size):
+                    batch = patches[start:start + self.model.batch_size]
+                    probs[start:start + len(batch)] = self.model.run_compiled('predict', batch)[:, 0]
+                offset = 0
+                for job in jobs:
+                    job['result'] = probs[offset:offset + len(job['patches'])]
+                    offset += len(job['patches'])
+            except Exception as error:
+                for job in jobs:
+                    job['error'] = error
+            for job in jobs:
+                job['done'].set()
+
+
+class PredictionAPI:
+    """Flask view scoring images with the models of a registry (or any dict of models)"""
+    def __init__(self, models, default_model, max_batch_size = 256, max_wait = 0.01,
+        max_content_length = 32 * 1024 * 1024, max_pixels = 4096 * 4096):
+        """
+        Args:
+            max_content_length (int, optional): Max size in bytes of a request body. Defaults to 32MB.
+            max_pixels (int, optional): Max number of pixels of the images of a request, together.
+                Defaults to 4096 x 4096.
+        """
+        self.models = models
+        self.default_model = default_model
+        self.max_content_length = max_content_length
+        self.max_pixels = max_pixels
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batchers = dict()
+        self.lock = threading.Lock()
+
+    def get_batcher(self, model):
+        # one batcher per set of weights, aliases of the same model share it
+        with self.lock:
+            if model.identity not in self.batchers:
+                self.batchers[model.identity] = MicroBatcher(model, self.max_batch_size, self.max_wait)
+            return self.batchers[model.identity]
+
+    def open_image(self, data):
+        # only the header is read, the pixels are decoded once the size of every image was checked
+        try:
+            return Image.open(io.BytesIO(data))
+        except Image.DecompressionBombError as error:
+            raise RequestEntityTooLarge(str(error))
+
+    def decode_images(self, images):
+        pixels = sum(image.width * image.height for image in images)
+        if pixels > self.max_pixels:
+            raise RequestEntityTooLarge(f"the images have {pixels} pixels, the limit is {self.max_pixels}")
+        return [np.asarray(image.convert('RGB')) for image in images]
+
+    def submit(self, model, image, roi = None):
+        """Queue the patches of an image (or ROI), returns what finish needs to build its result"""
+        if roi is not None:
+            x0, y0, x1, y1 = [int(value) for value in roi]
+            x0, x1 = min(x0, x1), max(x0, x1)
+            y0, y1 = min(y0, y1), max(y0, y1)
+            image = image[max(y0, 0):y1, max(x0, 0):x1]
+        if image.shape[0] == 0 or image.shape[1] == 0:
+            raise ValueError("empty image or ROI")
+        img_array = model.get_array_from_img(model.add_padding(image))
+        patches = model.get_patches(img_array[0])
+        rows, cols = patches.shape[0], patches.shape[1]
+        batcher = self.get_batcher(model)
+        job = batcher.submit(patches.reshape((rows * cols,) + patches.shape[2:]))
+        return batcher, job, image.shape, rows, cols
+
+    def finish(self, model, batcher, job, shape, rows, cols):
+        probs = batcher.wait(job)
+        return {
+            'shape': [rows, cols],
+            'patch_dim': list(model.patch_dim),
+            'padding': list(model.get_padding(shape)),
+            'probabilities': probs.reshape(rows, cols).round(4).tolist(),
+        }
+
+    def score(self, model, image, roi = None):
+        return self.finish(model, *self.submit(model, image, roi))
+
+    def __call__(self):
+        try:
+            if request.content_length is not None and request.content_length > self.max_content_length:
+                raise RequestEntityTooLarge(f"the body has {request.content_length} bytes, the limit is {self.max_content_length}")
+            if request.is_json:
+                body = request.get_json()
+                model_name = body.get('model', self.default_model)
+                images = [self.open_image(base64.b64decode(item['data'])) for item in body['images']]
+                rois = [item.get('roi') for item in body['images']]
+            else:
+                model_name = request.args.get('model', self.default_model)
+                roi = request.args.get('roi')
+                images = [self.open_image(request.get_data())]
+                rois = [roi.split(',') if roi else None]
+            if model_name not in self.models:
+                return jsonify({'error': f"unknown model {model_name}"}), 404
+            model = self.models[model_name]
+            # every image is queued before waiting, so the images of a request share batches
+            jobs = [self.submit(model, image, roi) for image, roi in zip(self.decode_images(images), rois)]
+            results = [self.finish(model, *job) for job in jobs]
+        except RequestEntityTooLarge as error:
+            return jsonify({'error': error.description}), 413
+        except (KeyError, TypeError, ValueError, OSError) as error:
+            return jsonify({'error': str(error)}), 400
+        return jsonify({'model': model_name, 'results': results})
+
+
+def register_prediction_api(server, models, default_model, route = '/api/predict', **kwargs):
+    """Mount the prediction API on a flask server (e.g. app.server)"""
+    api = PredictionAPI(models, default_model, **kwargs)
+    # bodies without a Content-Length (chunked) are cut by flask
+    if server.config.get('MAX_CONTENT_LENGTH') is None:
+        server.config['MAX_CONTENT_LENGTH'] = api.max_content_length
+    server.add_url_rule(route, 'predict_api', api, methods=['POST'])
+    return api
@@ -0,0 +1,229 @@
+"""Offline scoring of directories of images.
+Images are decoded by a pool of processes while the main process feeds their patches to the model
+in a single stream of full batches (patches of consecutive images share batches).
+For every image <name> of the input tree, the output tree gets:
+    <name>.overlay.png   the image tinted as tint_image does
+    <name>.probs.npy     (rows, cols) float32 probabilities, written last
+and when every image is scored:
+    summary.parquet        one row per image (size, patches, mean/max probability, positive fraction)
+    probabilities.parquet  one row per patch (image, row, col, probability)
+Parquet needs pyarrow, without it the tables are written as csv.
+Images whose probabilities already exist are skipped, so an interrupted run can be resumed.
+Run it from the app folder:
+    python -m components.predict.batch path/to/images --output scores --workers 8
+"""
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+
+def find_images(root):
+    """Relative paths of the images of a directory tree, sorted"""
+    paths = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.relpath(os.path.join(directory, name), root))
+    return sorted(paths)
+
+
+def decode_image(path):
+    # runs on the pool processes, only uint8 pixels are sent back
+    return np.asarray(Image.open(path).convert('RGB'))
+
+
+def write_table(frame, path):
+    """Write a table as parquet (or csv if pyarrow is not installed), returns the written path"""
+    if importlib.util.find_spec('pyarrow') is None:
+        path = f"{path}.csv"
+        frame.to_csv(path, index=False)
+        return path
+    path = f"{path}.parquet"
+    frame.to_parquet(path, index=False)
+    return path
+
+
+class PatchStream:
+    """Send the patches of a sequence of images to the model in full batches.
+    on_done(key, image, probs) is called with the padded uint8 image and the (rows, cols)
+    probability grid once every patch of an image is predicted.
+    """
+    def __init__(self, model, on_done):
+        self.model = model
+        self.on_done = on_done
+        self.pending = deque()
+        self.queued = 0
+
+    def add(self, key, image):
+        padded = self.model.add_padding(image)
+        patches = self.model.get_patches(self.model.get_array_from_img(padded)[0])
+        rows, cols = patches.shape[0], patches.shape[1]
+        self.pending.append({
+            'key': key, 'image': padded, 'patches': patches,
+            'probs': np.empty(rows * cols, dtype=np.float32), 'sent': 0, 'received': 0,
+        })
+        self.queued += rows * cols
+        self.run()
+
+    def run(self, flush = False):
+        batch_size = self.model.batch_size
+        while self.queued >= batch_size or (flush and self.queued > 0):
+            # take the next patches of the pending images, in order
+            parts, targets, size = [], [], 0
+            for entry in self.pending:
+                total = len(entry['probs'])
+                if entry['sent'] == total:
+                    continue
+                idx = np.arange(entry['sent'], min(total, entry['sent'] + batch_size - size))
+                cols = entry['patches'].shape[1]
+                parts.append(entry['patches'][idx // cols, idx % cols])
+                targets.append((entry, idx))
+                entry['sent'] += len(idx)
+                size += len(idx)
+                if size == batch_size:
+                    break
+            probs = self.model.run_compiled('predict', np.concatenate(parts))[:, 0]
+            self.queued -= size
+
+            offset = 0
+            for entry, idx in targets:
+                entry['probs'][idx] = probs[offset:offset + len(idx)]
+                entry['received'] += len(idx)
+                offset += len(idx)
+            while self.pending and self.pending[0]['received'] == len(self.pending[0]['probs']):
+                entry = self.pending.popleft()
+                grid = entry['probs'].reshape(entry['patches'].shape[0], entry['patches'].shape[1])
+                self.on_done(entry['key'], entry['image'], grid)
+
+    def flush(self):
+        self.run(flush = True)
+
+
+class BatchScorer:
+    """Score every image of a directory tree, see the module docstring for the outputs"""
+    def __init__(self, model, output, workers = None, prefetch = 4):
+        """
+        Args:
+            model (PatchPredictor): Model used to predict the patches.
+            output (str): Output folder.
+            workers (int, optional): Decoding processes. Defaults to the number of cores.
+            prefetch (int, optional): Decoded images waiting per worker, bounds the memory. Defaults to 4.
+        """
+        self.model = model
+        self.output = output
+        self.workers = workers or os.cpu_count()
+        self.prefetch = prefetch
+
+    def output_path(self, relative_path, suffix):
+        return os.path.join(self.output, os.path.splitext(relative_path)[0] + suffix)
+
+    def is_done(self, relative_path):
+        return os.path.exists(self.output_path(relative_path, '.probs.npy'))
+
+    def save(self, relative_path, image, probs):
+        overlay = self.model.compose_tint(image, probs)
+        overlay_path = self.output_path(relative_path, '.overlay.png')
+        os.makedirs(os.path.dirname(overlay_path), exist_ok=True)
+        Image.fromarray(overlay).save(overlay_path)
+        # the probabilities mark the image as done, they are written last and atomically
+        probs_path = self.output_path(relative_path, '.probs.npy')
+        tmp_path = f"{probs_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.save(file, probs)
+        os.replace(tmp_path, probs_path)
+
+    def score(self, root, log = print):
+        paths = find_images(root)
+        todo = [path for path in paths if not self.is_done(path)]
+        log(f"{len(paths)} images, {len(paths) - len(todo)} already scored")
+
+        start = time.perf_counter()
+        done = []
+        def on_done(relative_path, image, probs):
+            self.save(relative_path, image, probs)
+            done.append(relative_path)
+            log(f"[{len(done)}/{len(todo)}] {relative_path} {probs.size} patches "
+                f"({len(done) / (time.perf_counter() - start):.2f} images/s)")
+
+        stream = PatchStream(self.model, on_done)
+        # spawned workers, forking a process that already runs tensorflow is not safe
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.workers, mp_context=context) as pool:
+            futures = deque()
+            for path in todo:
+                futures.append((path, pool.submit(decode_image, os.path.join(root, path))))
+                # at most prefetch images per worker are decoded ahead of the model
+                while len(futures) >= self.workers * self.prefetch:
+                    self.consume(stream, *futures.popleft(), log)
+            while futures:
+                self.consume(stream, *futures.popleft(), log)
+        stream.flush()
+        return self.write_tables(paths)
+
+    def consume(self, stream, path, future, log):
+        try:
+            image = future.result()
+        except Exception as error:
+            log(f"{path}: can not be decoded ({error})")
+            return
+        stream.add(path, image)
+
+    def write_tables(self, paths):
+        summary, grids = [], []
+        for path in paths:
+            if not self.is_done(path):
+                continue
+            probs = np.load(self.output_path(path, '.probs.npy'))
+            summary.append({
+                'image': path, 'rows': probs.shape[0], 'cols': probs.shape[1], 'patches': probs.size,
+                'mean_probability': float(probs.mean()), 'max_probability': float(probs.max()),
+                'positive_fraction': float((probs > 0.5).mean()),
+            })
+            rows, cols = np.indices(probs.shape)
+            grids.append(pd.DataFrame({
+                'image': path, 'row': rows.ravel().astype(np.int32), 'col': cols.ravel().astype(np.int32),
+                'probability': probs.ravel(),
+            }))
+        os.makedirs(self.output, exist_ok=True)
+        summary_path = write_table(pd.DataFrame(summary), os.path.join(self.output, 'summary'))
+        if grids:
+            grid = pd.concat(grids, ignore_index=True)
+            grid['image'] = grid['image'].astype('category')
+            write_table(grid, os.path.join(self.output, 'probabilities'))
+        return summary_path
+
+
+def main():
+    app_path = Path(os.path.dirname(os.path.realpath(__file__))).parent.parent.absolute()
+    parser = argparse.ArgumentParser(description="Score every image of a directory tree")
+    parser.add_argument('images')
+    parser.add_argument('--output', default='scores')
+    parser.add_argument('--model', default=os.path.join(app_path, 'assets', 'models', 'classical_model.h5'))
+    parser.add_argument('--last-conv-layer', default='conv2d_2')
+    parser.add_argument('--backend', default='keras')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--prefetch', type=int, default=4)
+    args = parser.parse_args()
+
+    from components.predict.registry import ModelRegistry
+    registry = ModelRegistry()
+    registry.register('model', args.model, args.last_conv_layer, backend = args.backend, batch_size = args.batch_size)
+    scorer = BatchScorer(registry['model'], args.output, args.workers, args.prefetch)
+    print('summary ->', scorer.score(args.images))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class ResultCache:
+    """Content addressed cache of ROI prediction results.
+    Results are stored in a local sqlite file, so every gunicorn worker of the host shares them.
+    When the stored results exceed max_bytes the least recently used ones are evicted.
+    """
+    def __init__(self, directory = None, max_bytes = 256 * 1024 * 1024):
+        """
+        Args:
+            directory (str, optional): Where the cache file lives. Defaults to a folder in the temp dir.
+            max_bytes (int, optional): Max size of the stored results. Defaults to 256MB.
+        """
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), 'breast_cancer_roi_cache')
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'results.sqlite')
+        self.max_bytes = max_bytes
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, arrays BLOB, annotations TEXT, size INTEGER, last_access REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+
+    @contextmanager
+    def connect(self):
+        # a new connection per operation, connections can not be shared between forked workers
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def key(self, roi, *identity):
+        """Key of a ROI given its pixels and anything else the result depends on (model, patch size, mode...)"""
+        digest = hashlib.sha256()
+        digest.update(str((roi.shape, roi.dtype.str) + identity).encode())
+        digest.update(np.ascontiguousarray(roi).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return (arrays, annotations) stored under key or None"""
+        with self.connect() as connection:
+            row = connection.execute("SELECT arrays, annotations FROM results WHERE key = ?", (key,)).fetchone()
+            self.count(connection, 'hits' if row is not None else 'misses')
+            if row is None:
+                return None
+            connection.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+        with np.load(io.BytesIO(row[0])) as stored:
+            arrays = {name: stored[name] for name in stored.files}
+        return arrays, json.loads(row[1])
+
+    def set(self, key, arrays, annotations):
+        """Store a dict of numpy arrays and the annotations of a result"""
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        value = buffer.getvalue()
+        annotations = json.dumps(annotations)
+        size = len(value) + len(annotations)
+        if size > self.max_bytes:
+            return
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, value, annotations, size, time.time()))
+            self.evict(connection)
+
+    def evict(self, connection):
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in connection.execute("SELECT key, size FROM results ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def count(self, connection, name):
+        connection.execute(
+            "INSERT INTO stats VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def stats(self):
+        """Hits and misses of every worker plus the number and size of the stored results"""
+        with self.connect() as connection:
+            stats = dict(connection.execute("SELECT name, value FROM stats").fetchall())
+            entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {'hits': stats.get('hits', 0), 'misses': stats.get('misses', 0), 'entries': entries, 'bytes': size}
+
+    def clear(self):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM results")
+            connection.execute("DELETE FROM stats")
@@ -7,25 +7,62 @@ import os
 from pathlib import Path
 
 import tensorflow as tf
-from tensorflow import keras
-import cv2
 import numpy as np
-import math
 import matplotlib.pyplot as plt
-import matplotlib.cm as cm
+import threading
+from PIL import Image
+
+from components.predict.predictor import PatchPredictor
 
 #Set this as false on Production if GPU is enabled
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
-class Model:
+class Model(PatchPredictor):
     """convinient methods to use a tf model and perform realtime predictions
     """
-    def __init__(self, name, path, last_conv_layer, patch_dim = (50,50)):
+    # available inference backends for the patch predictions
+    BACKENDS = ('keras', 'float16', 'int8')
+
+    def __init__(self, name, path, last_conv_layer, patch_dim = (50,50), batch_size = 64, batch_buckets = (1, 8, 32), identity = None,
+        backend = 'keras', calibration_images = (), calibration_size = 200, tflite_threads = None):
+        """
+        Args:
+            backend (str, optional): 'keras', or 'float16'/'int8' to run the patch predictions on a post-training
+                quantized TFLite version of the model. Grad cam and sliding windows always use keras. Defaults to 'keras'.
+            calibration_images (tuple, optional): Paths of the images whose patches calibrate the int8 quantization.
+            calibration_size (int, optional): Number of calibration patches. Defaults to 200.
+            tflite_threads (int, optional): Threads used by the TFLite interpreter. Defaults to None (TFLite default).
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError(f"unknown backend {backend}, use one of {self.BACKENDS}")
+        #the identity defaults to the model path, quantized backends give different predictions
+        identity = os.path.realpath(path) if identity is None else identity
+        if backend != 'keras':
+            identity = f"{identity}-{backend}"
+        super().__init__(name, patch_dim, batch_size, identity)
         #load a model from the given path
-        self.name = name
         self.model = tf.keras.models.load_model(path)
-        self.patch_dim = patch_dim
         self.last_conv_layer = last_conv_layer
+        self.backend = backend
+        self.calibration_images = calibration_images
+        self.calibration_size = calibration_size
+        self.tflite_threads = tflite_threads
+        #quantized model and its interpreters (one per batch bucket), built on first use
+        self.tflite_model = None
+        self.interpreters = dict()
+        self.interpreters_lock = threading.Lock()
+        #compiled functions are specialized for these batch sizes, smaller batches are padded to the closest one
+        self.batch_buckets = sorted(set(b for b in batch_buckets if b < batch_size) | {batch_size})
+        #gradient model used by grad cam, built on first use
+        self.gradcam_model = None
+        #compiled inference and grad cam functions, traced once per batch bucket
+        self.predict_fn = tf.function(self.predict_step)
+        self.gradcam_fn = tf.function(self.gradcam_step)
+        self.signatures = dict()
+        #fully convolutional version of the model used for sliding windows, built on first use
+        self.dense_model = None
+        self.dense_stride = None
+        self.dense_fn = None
 
     #Useful image operations
     def get_img(self, path:str, size:tuple=None):
@@ -37,11 +74,6 @@ class Model:
         array = np.expand_dims(array, axis=0)
         return array
 
-    def get_array_from_img(self,img):
-        array = tf.keras.utils.img_to_array(img) / 255.0
-        array = np.expand_dims(array, axis=0)
-        return array
-    
     def predict_array(self, array, threshold = 0.5):
         y_pred = self.model.predict(array, verbose = 0)
         predicted_class = np.where(y_pred > threshold, 1,0)[0][0]
@@ -49,159 +81,181 @@ class Model:
 
     def predict_img(self, img, threshold = 0.5):
         self.predict_array(self, self.get_array_from_img(img), threshold = 0.5)
-    
-
-    def add_padding(self, roi_img):
-        PW = self.patch_dim[0]
-        PH = self.patch_dim[1]
-        #make the input shape of the roi image a multiple of PW and PH
-        width_mod = roi_img.shape[1] % PW
-        upper_width = roi_img.shape[1] + PW - width_mod
-        desired_width = upper_width
-
-        height_mod = roi_img.shape[0] % PH
-        upper_height = roi_img.shape[0] + PH - height_mod
-        desired_height = upper_height
-
-        border_left =  math.floor(abs(desired_width - roi_img.shape[1]) / 2)
-        border_right = math.ceil(abs(desired_width - roi_img.shape[1]) / 2)
-        border_top = math.floor(abs(desired_height - roi_img.shape[0]) / 2)
-        border_bottom = math.ceil(abs(desired_height - roi_img.shape[0]) / 2)
-
-        valid_roi = cv2.copyMakeBorder(
-            roi_img,
-            top=border_top,
-            bottom=border_bottom,
-            left=border_left,
-            right=border_right,
-            borderType=cv2.BORDER_CONSTANT,
-            value=[255, 255, 255]
-        )
-
-
-        return valid_roi
-
-
-
-
 
-    #see https://stackoverflow.com/questions/46020894/superimpose-heatmap-on-a-base-image-opencv-python
-    #given a large image tint with a red color the zones with cancer 
-    def tint_image(self, image):
-        image = self.add_padding(image)
-        img_array = self.get_array_from_img(image)
-
-        PH = self.patch_dim[0]
-        PW = self.patch_dim[1]
-
-        annotations = []
-
-        mask = np.zeros(img_array[0].shape).astype('float32')
-        for row in range(0,img_array[0].shape[0],PH):
-            for col in range(0,img_array[0].shape[1],PW):
-                patch = img_array[:,row:row+PH, col:col+PW, :]
-                # do not predict if patch shape is not valid
-                if patch.shape[1] < PW or patch.shape[2] < PH:
-                    continue
-                y_prob = self.model.predict(patch, verbose = 0)
-                scaled = 1 * cm.jet(y_prob[0][0])
-                if y_prob[0][0] > 0.1:
-                    mask[row:row+PH, col:col+PW, 0] = scaled[0] 
-                    mask[row:row+PH, col:col+PW, 1] = scaled[1] 
-                    mask[row:row+PH, col:col+PW, 2] = scaled[2] 
-                else:
-                    mask[row:row+PH, col:col+PW, :] = patch[0]
-
-                # setup text
-                text = str(round(y_prob[0][0], 2))
-                textX =  col + PW//2
-                textY =  row + PH//2
-                annotations.append({'x' : textX, 'y' : textY, 'text' : text })
-
-        mask = 255 * mask 
-        mask = mask.astype(np.uint8)
-        mask = cv2.GaussianBlur(mask,(9,9), 7)
-
-        result = cv2.addWeighted(mask, 0.3, (img_array[0] * 255).astype(np.uint8), 0.7, 0) 
-        return result, annotations
-
-    # use grad cam - code inspired by https://keras.io/examples/vision/grad_cam/
-    def make_gradcam_heatmap(self, img_array, model, last_conv_layer_name, pred_index=None):
-        grad_model = tf.keras.models.Model(
-            [model.inputs], [model.get_layer(last_conv_layer_name).output, model.output]
-        )
+    #Compiled signatures
+    def predict_step(self, batch):
+        return self.model(batch, training=False)
+
+    def input_signature(self, batch_size):
+        channels = self.model.input_shape[-1]
+        return tf.TensorSpec((batch_size, self.patch_dim[0], self.patch_dim[1], channels), tf.float32)
+
+    def get_signature(self, name, batch_size):
+        """Return the concrete function of the compiled 'predict' or 'gradcam' step for a batch bucket"""
+        key = (name, batch_size)
+        if key not in self.signatures:
+            if name == 'gradcam':
+                self.get_gradcam_model()
+                function = self.gradcam_fn
+            else:
+                function = self.predict_fn
+            self.signatures[key] = function.get_concrete_function(self.input_signature(batch_size))
+        return self.signatures[key]
+
+    def run_compiled(self, name, batch):
+        """Run a compiled step over a batch, padding it up to the closest batch bucket"""
+        size = batch.shape[0]
+        bucket = next(b for b in self.batch_buckets if b >= size)
+        if bucket > size:
+            padding = np.zeros((bucket - size,) + batch.shape[1:], dtype=np.float32)
+            batch = np.concatenate([batch, padding])
+        if name == 'predict' and self.backend != 'keras':
+            return self.run_tflite(batch)[:size]
+        outputs = self.get_signature(name, bucket)(tf.constant(batch, dtype=tf.float32))
+        return tf.nest.map_structure(lambda output: output.numpy()[:size], outputs)
+
+    #Quantized TFLite backend
+    def calibration_patches(self):
+        """Random sample of patches of the calibration images, used as representative dataset for int8"""
+        patches = []
+        for path in self.calibration_images:
+            image = np.asarray(Image.open(path).convert('RGB'))
+            img_array = self.get_array_from_img(image)[0]
+            grid = self.get_patches(img_array)
+            patches.append(grid.reshape((-1,) + grid.shape[2:]))
+        if len(patches) == 0:
+            raise ValueError("int8 quantization needs calibration_images")
+        patches = np.concatenate(patches)
+        rng = np.random.default_rng(42)
+        return patches[rng.permutation(len(patches))[:self.calibration_size]]
+
+    def get_tflite_model(self):
+        """Convert (once) the keras model to TFLite with float16 or int8 post-training quantization"""
+        if self.tflite_model is None:
+            converter = tf.lite.TFLiteConverter.from_keras_model(self.model)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if self.backend == 'float16':
+                converter.target_spec.supported_types = [tf.float16]
+            else:
+                # inputs and outputs stay float32, so the backend is a drop in replacement
+                patches = self.calibration_patches()
+                converter.representative_dataset = lambda: ([patch[np.newaxis]] for patch in patches)
+            self.tflite_model = converter.convert()
+        return self.tflite_model
+
+    def get_interpreter(self, batch_size):
+        # the interpreters are allocated once per batch bucket, resizing them on every call is expensive
+        if batch_size not in self.interpreters:
+            interpreter = tf.lite.Interpreter(model_content=self.get_tflite_model(), num_threads=self.tflite_threads)
+            input_index = interpreter.get_input_details()[0]['index']
+            interpreter.resize_tensor_input(input_index, [batch_size, self.patch_dim[0], self.patch_dim[1], self.model.input_shape[-1]])
+            interpreter.allocate_tensors()
+            self.interpreters[batch_size] = interpreter
+        return self.interpreters[batch_size]
+
+    def run_tflite(self, batch):
+        # interpreters are not thread safe
+        with self.interpreters_lock:
+            interpreter = self.get_interpreter(batch.shape[0])
+            interpreter.set_tensor(interpreter.get_input_details()[0]['index'], np.asarray(batch, dtype=np.float32))
+            interpreter.invoke()
+            return interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+
+    def warmup(self):
+        """Trace and run every compiled signature once, so the first request does not pay for it"""
+        for bucket in self.batch_buckets:
+            batch = np.zeros(self.input_signature(bucket).shape.as_list(), dtype=np.float32)
+            self.run_compiled('predict', batch)
+            self.run_compiled('gradcam', batch)
+        # the fully convolutional signature accepts any image size, a single trace is enough
+        channels = self.model.input_shape[-1]
+        self.predict_dense(np.zeros((2 * self.patch_dim[0], 2 * self.patch_dim[1], channels), dtype=np.float32))
+
+    def get_gradcam_model(self):
+        #the gradient model is built only once per instance
+        if self.gradcam_model is None:
+            self.gradcam_model = tf.keras.models.Model(
+                [self.model.inputs], [self.model.get_layer(self.last_conv_layer).output, self.model.output]
+            )
+        return self.gradcam_model
+
+    def gradcam_step(self, batch):
+        """Compute the grad cam heatmaps of a batch of patches with a single tape pass.
+        Returns the (B, h, w) heatmaps and the (B,) predictions of the same forward pass.
+        """
         with tf.GradientTape() as tape:
-            last_conv_layer_output, preds = grad_model(img_array)
-            
-            if pred_index is None:
-                pred_index = tf.argmax(preds[0])
-            class_channel = preds[:, pred_index]
+            last_conv_layer_output, preds = self.gradcam_model(batch, training=False)
+            # the model has a single sigmoid output
+            class_channel = preds[:, 0]
 
+        # each prediction only depends on its own patch, so the gradient of the batch
+        # is the gradient of every patch
         grads = tape.gradient(class_channel, last_conv_layer_output)
 
-        pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-
-        last_conv_layer_output = last_conv_layer_output[0]
-        heatmap = last_conv_layer_output @ pooled_grads[..., tf.newaxis]
-        heatmap = tf.squeeze(heatmap)
-
-        heatmap = tf.maximum(heatmap, 0) / tf.math.reduce_max(heatmap)
-        return heatmap.numpy()
-
-    def gradcam(self, img, heatmap, alpha=0.7):
-        img = img * 255.0
-        img = img.astype(np.float32)
-        
-        # Rescale heatmap to a range 0-255
-        heatmap = np.uint8(255 * heatmap)
-        # Use jet colormap to colorize heatmap
-        jet = cm.get_cmap("jet") #jet
-        # Use RGB values of the colormap
-        jet_colors = jet(np.arange(256))[:, :3]
-        jet_heatmap = jet_colors[heatmap]
-        # Create an image with RGB colorized heatmap
-        jet_heatmap = keras.preprocessing.image.array_to_img(jet_heatmap)
-        jet_heatmap = jet_heatmap.resize((img.shape[1], img.shape[0]))
-        jet_heatmap = keras.preprocessing.image.img_to_array(jet_heatmap)
-        
-        return jet_heatmap / 255.0
-
-
-                
-    def tint_with_gradcam(self, image):
-        image = self.add_padding(image)
-        img_array = self.get_array_from_img(image)
-
-
-        PH = self.patch_dim[0]
-        PW = self.patch_dim[1]
-        output_image = np.zeros(image.shape)
-        heatmap_image = np.zeros(image.shape)
-        annotations = []
-
-        for row in range(0,image.shape[0],PH):
-            for col in range(0,image.shape[1],PW):
-                patch = img_array[:,row:row+PH, col:col+PW, :]
-                # do not predict if patch shape is not valid
-                if patch.shape[1] < PW or patch.shape[2] < PH:
-                    continue
-                heatmap = self.make_gradcam_heatmap(patch, self.model, self.last_conv_layer, pred_index = 0)
-                heat = self.gradcam(patch[0], heatmap, alpha=0.3)
-                output_image[row:row+PH, col:col+PW, :] =  patch[0]
-                heatmap_image[row:row+PH, col:col+PW, :] = heat
-
-                y_prob = self.model.predict(patch, verbose = 0)
-                # setup text
-                text = str(round(y_prob[0][0], 2))
-                textX =  col + PW//2
-                textY =  row + PH//2
-                annotations.append({'x' : textX, 'y' : textY, 'text' : text })
-
-
-
-        heatmap_image = cv2.GaussianBlur(heatmap_image,(5,5), 5)
-        # Superimpose the heatmap on original image
-        superimposed_img = cv2.addWeighted(output_image, 1-0.3, heatmap_image, 0.3, 0) #jet_heatmap * alpha + img
-
-        return superimposed_img, heatmap_image, annotations
-
+        pooled_grads = tf.reduce_mean(grads, axis=(1, 2))
+        heatmaps = tf.einsum('bhwk,bk->bhw', last_conv_layer_output, pooled_grads)
+
+        heatmaps = tf.maximum(heatmaps, 0) / tf.math.reduce_max(heatmaps, axis=(1, 2), keepdims=True)
+        return heatmaps, class_channel
+
+    # Sliding windows: the dense head is converted to convolutions, so the conv trunk runs once over the whole image
+    def get_fully_convolutional_model(self):
+        """Build (once) an equivalent fully convolutional model sharing the weights of the classifier.
+        The Dense layer after Flatten becomes a convolution with the kernel size of the flattened feature map
+        and the following Dense layers become 1x1 convolutions.
+        """
+        if self.dense_model is not None:
+            return self.dense_model
+
+        layers = self.model.layers
+        flatten_index = next((i for i, layer in enumerate(layers) if isinstance(layer, tf.keras.layers.Flatten)), None)
+        if flatten_index is None:
+            raise ValueError(f"model {self.name} has no Flatten layer, it can not be made fully convolutional")
+
+        inputs = tf.keras.Input(shape=(None, None, self.model.input_shape[-1]))
+        x = inputs
+        stride = 1
+        for layer in layers[:flatten_index]:
+            x = layer(x)
+            # output stride of the trunk, every pooling/strided conv reduces the resolution
+            if hasattr(layer, 'strides'):
+                stride *= layer.strides[0]
+
+        kernel_size = layers[flatten_index].input_shape[1:3]
+        head_layers = []
+        for layer in layers[flatten_index + 1:]:
+            if isinstance(layer, tf.keras.layers.Dense):
+                conv = tf.keras.layers.Conv2D(layer.units, kernel_size, activation=layer.activation)
+                x = conv(x)
+                head_layers.append((conv, layer))
+                kernel_size = (1, 1)
+            else:
+                # Dropout and similar layers are the identity at inference time
+                x = layer(x)
+
+        for conv, dense in head_layers:
+            kernel, bias = dense.get_weights()
+            conv.set_weights([kernel.reshape(tuple(conv.kernel.shape)), bias])
+
+        self.dense_model = tf.keras.models.Model(inputs, x)
+        self.dense_stride = stride
+        self.dense_fn = tf.function(
+            lambda image: self.dense_model(image, training=False),
+            input_signature=[tf.TensorSpec((1, None, None, self.model.input_shape[-1]), tf.float32)]
+        )
+        return self.dense_model
+
+    def get_window_stride(self, stride):
+        """Windows are evaluated at the output stride of the conv trunk, the requested stride is snapped to a multiple of it"""
+        self.get_fully_convolutional_model()
+        return max(1, round(stride / self.dense_stride)) * self.dense_stride
+
+    def predict_dense(self, img_array, stride = None):
+        """Predict the probability of every window of size patch_dim placed each `stride` pixels.
+        Returns a (rows, cols) float32 probability grid, cell (i, j) is the window starting at (i*stride, j*stride).
+        """
+        self.get_fully_convolutional_model()
+        stride = self.dense_stride if stride is None else self.get_window_stride(stride)
+        step = stride // self.dense_stride
+        output = self.dense_fn(tf.constant(img_array[np.newaxis], dtype=tf.float32))
+        return np.ascontiguousarray(output.numpy()[0, ::step, ::step, 0])
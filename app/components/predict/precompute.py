@@ -0,0 +1,93 @@
+"""Precomputed probability maps of the sample images.
+The maps are stored next to each image and depend on the model weights and the patch size.
+Build step, run from the app folder:
+    python -m components.predict.precompute
+"""
+import argparse
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from skimage import io
+
+
+def probability_map_path(model, image_path):
+    digest = hashlib.sha256(f"{model.identity}-{tuple(model.patch_dim)}".encode()).hexdigest()[:16]
+    root, _ = os.path.splitext(image_path)
+    return f"{root}.{digest}.probs.npy"
+
+
+def load_probability_map(model, image_path):
+    """Return the probability map of an image or None if it was not precomputed"""
+    path = probability_map_path(model, image_path)
+    if not os.path.exists(path):
+        return None
+    return np.load(path)
+
+
+def precompute_probability_map(model, image_path, overwrite = False):
+    """Score a whole image and store its probability map next to it"""
+    path = probability_map_path(model, image_path)
+    if os.path.exists(path) and not overwrite:
+        return path
+    probability_map = model.get_probability_map(io.imread(image_path))
+    # write to a temporary file first, so other workers never read a partial map
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        np.save(file, probability_map)
+    os.replace(tmp_path, path)
+    return path
+
+
+_requested = set()
+_requested_lock = threading.Lock()
+
+def precompute_in_background(models, alias, image_path):
+    """Speculatively compute a missing probability map in a background thread.
+    The model of the alias is looked up (and loaded if needed) in the thread, so the caller never waits,
+    and nothing is done for an unknown alias or a (alias, image) pair that was already requested.
+    """
+    if alias is None or alias not in models:
+        return
+    with _requested_lock:
+        if (alias, image_path) in _requested:
+            return
+        _requested.add((alias, image_path))
+
+    def run():
+        try:
+            precompute_probability_map(models[alias], image_path)
+        except Exception:
+            # a later request of the pair tries again
+            with _requested_lock:
+                _requested.discard((alias, image_path))
+            raise
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def main():
+    app_path = Path(os.path.dirname(os.path.realpath(__file__))).parent.parent.absolute()
+    parser = argparse.ArgumentParser(description="Precompute the probability maps of the sample images")
+    parser.add_argument('--images', default=os.path.join(app_path, 'assets', 'imgs'))
+    parser.add_argument('--model', default=os.path.join(app_path, 'assets', 'models', 'classical_model.h5'))
+    parser.add_argument('--last-conv-layer', default='conv2d_2')
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    from components.predict.registry import ModelRegistry
+    registry = ModelRegistry(warmup = False)
+    registry.register('model', args.model, args.last_conv_layer)
+    model = registry['model']
+
+    for name in sorted(os.listdir(args.images)):
+        if not name.endswith('.png'):
+            continue
+        path = precompute_probability_map(model, os.path.join(args.images, name), args.overwrite)
+        print(name, '->', os.path.basename(path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+import math
+import threading
+from functools import lru_cache
+
+import cv2
+import numpy as np
+import matplotlib.cm as cm
+from numpy.lib.stride_tricks import as_strided
+
+
+#jet colormap as a lookup table, cm.jet(p) is JET_LUT[jet_index(p)]
+JET_LUT = cm.jet(np.arange(256))[:, :3].astype(np.float32)
+JET_LUT_UINT8 = (255 * JET_LUT).astype(np.uint8)
+
+
+def jet_index(values):
+    """Index of JET_LUT of each value in [0, 1], the same bin matplotlib picks"""
+    index = (np.asarray(values) * 256).astype(np.int64)
+    return np.clip(index, 0, 255)
+
+
+def bicubic(x, a = -0.5):
+    x = np.abs(x)
+    return np.where(x < 1, ((a + 2) * x - (a + 3)) * x * x + 1,
+        np.where(x < 2, (((x - 5) * x + 8) * x - 4) * a, 0.0))
+
+
+@lru_cache(maxsize=None)
+def resize_matrix(in_size, out_size):
+    """(out_size, in_size) weights of a 1D bicubic resize, computed as PIL does"""
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    support = 2.0 * filter_scale
+    matrix = np.zeros((out_size, in_size), dtype=np.float32)
+    for x in range(out_size):
+        center = (x + 0.5) * scale
+        low = max(int(center - support + 0.5), 0)
+        high = min(int(center + support + 0.5), in_size)
+        weights = bicubic((np.arange(low, high) - center + 0.5) / filter_scale)
+        matrix[x, low:high] = weights / weights.sum()
+    return matrix
+
+
+class PatchPredictor:
+    """Split images in patches and tint them with the predictions of a patch classifier.
+    This class does not depend on tensorflow, subclasses provide the inference:
+    run_compiled for batches of patches and predict_dense/get_window_stride for sliding windows.
+    """
+    # stride (in pixels) of the sliding windows when none is given
+    DEFAULT_WINDOW_STRIDE = 16
+
+    def __init__(self, name, patch_dim = (50,50), batch_size = 64, identity = None):
+        self.name = name
+        #identifies the weights of the model (e.g. on result caches)
+        self.identity = name if identity is None else identity
+        self.patch_dim = patch_dim
+        #max number of patches sent to the model on each call
+        self.batch_size = batch_size
+        #scratch images of the compositor, one set per thread
+        self.buffers = threading.local()
+
+    #Inference, implemented by subclasses
+    def run_compiled(self, name, batch):
+        """Run the 'predict' or 'gradcam' step over a batch of patches"""
+        raise NotImplementedError
+
+    def get_window_stride(self, stride):
+        raise NotImplementedError
+
+    def predict_dense(self, img_array, stride = None):
+        raise NotImplementedError
+
+    #Useful image operations
+    def get_array_from_img(self,img):
+        array = np.asarray(img, dtype=np.float32) / 255.0
+        array = np.expand_dims(array, axis=0)
+        return array
+
+    def get_padding(self, shape):
+        """Return the (top, bottom, left, right) borders that make a ROI of the given shape a multiple of the patch size"""
+        PW = self.patch_dim[0]
+        PH = self.patch_dim[1]
+        #make the input shape of the roi image a multiple of PW and PH
+        width_mod = shape[1] % PW
+        upper_width = shape[1] + PW - width_mod
+        desired_width = upper_width
+
+        height_mod = shape[0] % PH
+        upper_height = shape[0] + PH - height_mod
+        desired_height = upper_height
+
+        border_left =  math.floor(abs(desired_width - shape[1]) / 2)
+        border_right = math.ceil(abs(desired_width - shape[1]) / 2)
+        border_top = math.floor(abs(desired_height - shape[0]) / 2)
+        border_bottom = math.ceil(abs(desired_height - shape[0]) / 2)
+        return border_top, border_bottom, border_left, border_right
+
+    def add_padding(self, roi_img):
+        border_top, border_bottom, border_left, border_right = self.get_padding(roi_img.shape)
+
+        valid_roi = cv2.copyMakeBorder(
+            roi_img,
+            top=border_top,
+            bottom=border_bottom,
+            left=border_left,
+            right=border_right,
+            borderType=cv2.BORDER_CONSTANT,
+            value=[255, 255, 255]
+        )
+
+
+        return valid_roi
+
+    def get_buffer(self, name, shape, dtype):
+        """Scratch array reused between calls of the same thread while the shape does not change"""
+        buffer = getattr(self.buffers, name, None)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            setattr(self.buffers, name, buffer)
+        return buffer
+
+    def get_cells(self, image):
+        """(rows, PH, cols, PW, C) view of a contiguous padded image, cells[i, :, j] is the patch (i, j)"""
+        PH = self.patch_dim[0]
+        PW = self.patch_dim[1]
+        return image.reshape(image.shape[0] // PH, PH, image.shape[1] // PW, PW, image.shape[2])
+
+    def get_patches(self, img_array):
+        """Return a (rows, cols, PH, PW, C) view over the patches of a padded image array.
+        No data is copied, every patch points to the memory of img_array.
+        """
+        PH = self.patch_dim[0]
+        PW = self.patch_dim[1]
+        rows = img_array.shape[0] // PH
+        cols = img_array.shape[1] // PW
+        s_row, s_col, s_channel = img_array.strides
+        return as_strided(img_array,
+            shape = (rows, cols, PH, PW, img_array.shape[2]),
+            strides = (s_row * PH, s_col * PW, s_row, s_col, s_channel),
+            writeable = False
+        )
+
+    def iter_patch_batches(self, patches, indices = None, progress = None):
+        """Iterate over a (rows, cols, PH, PW, C) patch grid in batches of at most self.batch_size patches.
+        Only the patches of the given flat (row-major) indices are visited, all of them by default.
+        Yields the flat indices of the batch and a contiguous (B, PH, PW, C) array.
+        progress is an optional callable, called with (done, total) patches after each batch is processed.
+        """
+        rows, cols = patches.shape[0], patches.shape[1]
+        if indices is None:
+            indices = np.arange(rows * cols)
+        for start in range(0, len(indices), self.batch_size):
+            idx = indices[start:start + self.batch_size]
+            # only the patches of the current batch are gathered into a contiguous array
+            yield idx, patches[idx // cols, idx % cols]
+            if progress is not None:
+                progress(start + len(idx), len(indices))
+
+    def predict_patches(self, patches, known = None, progress = None):
+        """Predict the probability of each patch of a (rows, cols, PH, PW, C) patch grid.
+        known is an optional (rows, cols) grid of already known probabilities (nan when unknown),
+        only the unknown patches are sent to the model.
+        Returns a (rows, cols) float32 probability grid.
+        """
+        rows, cols = patches.shape[0], patches.shape[1]
+        if known is None:
+            probs = np.empty(rows * cols, dtype=np.float32)
+            indices = None
+        else:
+            probs = known.astype(np.float32).reshape(-1)
+            indices = np.flatnonzero(np.isnan(probs))
+        for idx, batch in self.iter_patch_batches(patches, indices, progress):
+            y_prob = self.run_compiled('predict', batch)
+            probs[idx] = y_prob[:, 0]
+        return probs.reshape(rows, cols)
+
+    #Precomputed probability maps
+    def get_probability_map(self, image):
+        """Probability grid of the patches of a whole image, tiled from its top left corner without padding"""
+        img_array = self.get_array_from_img(image)[0]
+        PH = self.patch_dim[0]
+        PW = self.patch_dim[1]
+        rows = img_array.shape[0] // PH
+        cols = img_array.shape[1] // PW
+        return self.predict_patches(self.get_patches(img_array[:rows * PH, :cols * PW]))
+
+    def slice_probability_map(self, probability_map, roi_shape, origin):
+        """Take from a precomputed probability map the probabilities of the patches of a padded ROI.
+        origin is the (row, col) of the ROI on the image of the map. Patches that contain padding or
+        that are not aligned with the map are returned as nan, so they are predicted live.
+        """
+        PH = self.patch_dim[0]
+        PW = self.patch_dim[1]
+        top, bottom, left, right = self.get_padding(roi_shape)
+        rows = (roi_shape[0] + top + bottom) // PH
+        cols = (roi_shape[1] + left + right) // PW
+        known = np.full((rows, cols), np.nan, dtype=np.float32)
+
+        # position of the padded ROI grid on the image
+        grid_row = origin[0] - top
+        grid_col = origin[1] - left
+        if origin[0] < 0 or origin[1] < 0 or grid_row % PH != 0 or grid_col % PW != 0:
+            return known
+
+        row_index = np.arange(rows)
+        col_index = np.arange(cols)
+        map_rows = grid_row // PH + row_index
+        map_cols = grid_col // PW + col_index
+        # only patches fully inside the ROI and the map
+        valid_rows = (row_index * PH >= top) & ((row_index + 1) * PH <= top + roi_shape[0]) & (map_rows >= 0) & (map_rows < probability_map.shape[0])
+        valid_cols = (col_index * PW >= left) & ((col_index + 1) * PW <= left + roi_shape[1]) & (map_cols >= 0) & (map_cols < probability_map.shape[1])
+        known[np.ix_(valid_rows, valid_cols)] = probability_map[np.ix_(map_rows[valid_rows], map_cols[valid_cols])]
+        return known
+
+    def get_annotations(self, probs, spacing = None, step = 1):
+        """Text annotations with the probability of every step-th cell of a (rows, cols) grid.
+        spacing is the (vertical, horizontal) distance in pixels between cells, the patch size by default.
+        """
+        PH = self.patch_dim[0]
+        PW = self.patch_dim[1]
+        spacing = self.patch_dim if spacing is None else spacing
+        annotations = []
+        for i in range(0, probs.shape[0], step):
+            for j in range(0, probs.shape[1], step):
+                # setup text
+                text = str(round(probs[i, j], 2))
+                textX =  j * spacing[1] + PW//2
+                textY =  i * spacing[0] + PH//2
+                annotations.append({'x' : textX, 'y' : textY, 'text' : text })
+        return annotations
+
+    #see https://stackoverflow.com/questions/46020894/superimpose-heatmap-on-a-base-image-opencv-python
+    #given a large image tint with a red color the zones with cancer 
+    def tint_image(self, image, probability_map = None, origin = None, progress = None):
+        """Tint the patches of an image with their probability.
+        If the image is a ROI of a bigger image, the precomputed probability_map of that image and
+        the (row, col) origin of the ROI can be given to avoid predicting the patches again.
+        """
+        probs = self.tint_probabilities(image, probability_map, origin, progress)
+        return self.render_tint(image, probs)
+
+    def tint_probabilities(self, image, probability_map = None, origin = None, progress = None):
+        """(rows, cols) probabilities of the patches of the padded image, see tint_image"""
+        known = None
+        if probability_map is not None and origin is not None:
+            known = self.slice_probability_map(probability_map, image.shape, origin)
+        img_array = self.get_array_from_img(self.add_padding(image))
+        return self.predict_patches(self.get_patches(img_array[0]), known, progress)
+
+    def render_tint(self, image, probs):
+        """tint_image of an image whose probabilities are already known"""
+        img_array = self.get_array_from_img(self.add_padding(image))
+        result = self.compose_tint((img_array[0] * 255).astype(np.uint8), probs)
+        return result, self.get_annotations(probs)
+
+    def compose_tint(self, base, probs):
+        """Blend the colors of a (rows, cols) probability grid over the uint8 padded image of its patches.
+        base is overwritten with the result.
+        """
+        # every patch gets the color of its probability, patches under 0.1 keep their pixels
+        mask = self.get_buffer('mask', base.shape, np.uint8)
+        mask_cells = self.get_cells(mask)
+        mask_cells[...] = JET_LUT_UINT8[jet_index(probs)][:, np.newaxis, :, np.newaxis, :]
+        low_rows, low_cols = np.nonzero(probs <= 0.1)
+        mask_cells[low_rows, :, low_cols] = self.get_cells(base)[low_rows, :, low_cols]
+        cv2.GaussianBlur(mask, (9,9), 7, dst=mask)
+
+        return cv2.addWeighted(mask, 0.3, base, 0.7, 0, dst=base)
+
+    def colorize_heatmaps(self, heatmaps):
+        """Color a (B, h, w) batch of Grad-CAM heatmaps with jet and resize them to the patch size.
+        Returns a (B, PH, PW, 3) uint8 array, same as keras array_to_img and a bicubic PIL resize.
+        """
+        colors = JET_LUT[np.uint8(255 * heatmaps)]
+        # scale each heatmap to 0-255 as keras array_to_img does
+        colors -= colors.min(axis=(1, 2, 3), keepdims=True)
+        maxima = colors.max(axis=(1, 2, 3), keepdims=True)
+        np.divide(colors, maxima, out=colors, where=maxima != 0)
+        colors = (colors * 255).astype(np.uint8).astype(np.float32)
+        # separable resize, horizontal pass first and rounded to uint8 between passes like PIL
+        resized = np.einsum('xw,bhwc->bhxc', resize_matrix(colors.shape[2], self.patch_dim[1]), colors)
+        np.clip(np.rint(resized, out=resized), 0, 255, out=resized)
+        resized = np.einsum('yh,bhxc->byxc', resize_matrix(colors.shape[1], self.patch_dim[0]), resized)
+        np.clip(np.rint(resized, out=resized), 0, 255, out=resized)
+        return resized.astype(np.uint8)
+
+    def make_gradcam_heatmaps(self, batch):
+        return self.run_compiled('gradcam', batch)
+
+    def tint_with_gradcam(self, image, progress = None):
+        heatmaps, probs = self.gradcam_heatmaps(image, progress)
+        return self.render_gradcam(image, heatmaps, probs)
+
+    def gradcam_heatmaps(self, image, progress = None):
+        """Grad-CAM heatmaps (rows, cols, h, w) and (rows, cols) probabilities of the patches of the padded image"""
+        img_array = self.get_array_from_img(self.add_padding(image))
+        patches = self.get_patches(img_array[0])
+        rows, cols = patches.shape[0], patches.shape[1]
+        probs = np.empty(rows * cols, dtype=np.float32)
+        heatmaps = None
+        for idx, batch in self.iter_patch_batches(patches, progress = progress):
+            batch_heatmaps, y_prob = self.make_gradcam_heatmaps(batch)
+            if heatmaps is None:
+                heatmaps = np.empty((rows * cols,) + batch_heatmaps.shape[1:], dtype=np.float32)
+            heatmaps[idx] = batch_heatmaps
+            probs[idx] = y_prob
+        return heatmaps.reshape((rows, cols) + heatmaps.shape[1:]), probs.reshape(rows, cols)
+
+    def render_gradcam(self, image, heatmaps, probs):
+        """tint_with_gradcam of an image whose heatmaps and probabilities are already known"""
+        img_array = self.get_array_from_img(self.add_padding(image))
+        rows, cols = probs.shape
+        heatmaps = heatmaps.reshape((rows * cols,) + heatmaps.shape[2:])
+
+        # the colored heatmaps of each batch are written straight into their cells
+        colored = self.get_buffer('heatmap', img_array[0].shape, np.uint8)
+        colored_cells = self.get_cells(colored)
+        for start in range(0, rows * cols, self.batch_size):
+            idx = np.arange(start, min(start + self.batch_size, rows * cols))
+            colored_cells[idx // cols, :, idx % cols] = self.colorize_heatmaps(heatmaps[idx])
+
+        heatmap_image = np.multiply(colored, np.float32(1 / 255.0), dtype=np.float32)
+        cv2.GaussianBlur(heatmap_image, (5,5), 5, dst=heatmap_image)
+        # Superimpose the heatmap on original image
+        superimposed_img = cv2.addWeighted(img_array[0], 1-0.3, heatmap_image, 0.3, 0) #jet_heatmap * alpha + img
+
+        return superimposed_img, heatmap_image, self.get_annotations(probs)
+
+    def tint_sliding_window(self, image, stride = None, progress = None):
+        probs, stride = self.sliding_window_probabilities(image, stride, progress)
+        return self.render_sliding_window(image, probs, stride)
+
+    def sliding_window_probabilities(self, image, stride = None, progress = None):
+        """(rows, cols) probabilities of the windows of the padded image and the stride of the windows,
+        the closest to the given one (DEFAULT_WINDOW_STRIDE if None) the model supports"""
+        img_array = self.get_array_from_img(self.add_padding(image))
+        stride = self.get_window_stride(self.DEFAULT_WINDOW_STRIDE if stride is None else stride)
+        probs = self.predict_dense(img_array[0], stride)
+        # the whole image is predicted in a single pass
+        if progress is not None:
+            progress(1, 1)
+        return probs, stride
+
+    def render_sliding_window(self, image, probs, stride):
+        """tint_sliding_window of an image whose window probabilities are already known"""
+        image = self.add_padding(image)
+        img_array = self.get_array_from_img(image)
+
+        PH = self.patch_dim[0]
+        PW = self.patch_dim[1]
+        rows, cols = probs.shape
+
+        # each cell covers the stride x stride square around its window center,
+        # the borders that no center reaches take the value of the closest cell
+        upsampled = cv2.resize(probs, (cols * stride, rows * stride), interpolation=cv2.INTER_LINEAR)
+        top = max(0, (PH - stride) // 2)
+        left = max(0, (PW - stride) // 2)
+        upsampled = upsampled[:image.shape[0] - top, :image.shape[1] - left]
+        prob_image = cv2.copyMakeBorder(upsampled,
+            top = top,
+            bottom = image.shape[0] - top - upsampled.shape[0],
+            left = left,
+            right = image.shape[1] - left - upsampled.shape[1],
+            borderType = cv2.BORDER_REPLICATE
+        )
+
+        base = (img_array[0] * 255).astype(np.uint8)
+        mask = self.get_buffer('mask', base.shape, np.uint8)
+        np.take(JET_LUT_UINT8, jet_index(prob_image), axis=0, out=mask)
+        low = prob_image <= 0.1
+        mask[low] = base[low]
+        cv2.GaussianBlur(mask, (9,9), 7, dst=mask)
+
+        # annotate roughly one window per patch to keep the figure readable
+        annotations = self.get_annotations(probs, (stride, stride), max(1, round(PH / stride)))
+
+        result = cv2.addWeighted(mask, 0.3, base, 0.7, 0, dst=base)
+        return result, annotations
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import threading
+import time
+
+
+class ModelRegistry:
+    """Lazily load models and share a single instance between every alias that points to the same weights.
+    Models are identified by their file and content hash, loaded on first use and evicted
+    (least recently used first) when the loaded models exceed the memory budget.
+    """
+    def __init__(self, memory_budget = None, idle_timeout = 600, warmup = True, server = None):
+        """
+        Args:
+            memory_budget (int, optional): Max bytes of weights kept in memory. Defaults to None (no limit).
+            idle_timeout (int, optional): Seconds after which an unused model can be evicted. Defaults to 600.
+            warmup (bool, optional): Trace the compiled signatures of a model as soon as it is loaded. Defaults to True.
+            server (str, optional): Socket of an inference server. If given, models are RemoteModel clients
+                and tensorflow is never imported by this process. Defaults to None.
+        """
+        self.memory_budget = memory_budget
+        self.idle_timeout = idle_timeout
+        self.warmup = warmup
+        self.server = server
+        self.specs = dict()
+        self.instances = dict()
+        self.sizes = dict()
+        self.last_used = dict()
+        self.hashes = dict()
+        # the registry lock only guards the dicts, models are loaded under a lock of their own key
+        self.lock = threading.RLock()
+        self.loading = dict()
+        # a forked process (e.g. a background job) gets unlocked copies of the locks
+        os.register_at_fork(after_in_child = self.reset_locks)
+
+    def reset_locks(self):
+        self.lock = threading.RLock()
+        self.loading = dict()
+
+    def register(self, alias, path, last_conv_layer, **kwargs):
+        """Register a model under an alias, nothing is loaded until the alias is used"""
+        self.specs[alias] = dict(path = os.path.realpath(path), last_conv_layer = last_conv_layer, kwargs = kwargs)
+
+    # dict like access, so the registry can be used as the `models` dict of the pages
+    def __getitem__(self, alias):
+        return self.get(alias)
+
+    def __contains__(self, alias):
+        return alias in self.specs
+
+    def __iter__(self):
+        return iter(self.specs)
+
+    def __len__(self):
+        return len(self.specs)
+
+    def keys(self):
+        return self.specs.keys()
+
+    def file_hash(self, path):
+        #the hash is only recomputed if the file changed
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if path not in self.hashes or self.hashes[path][0] != signature:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+            self.hashes[path] = (signature, digest.hexdigest())
+        return self.hashes[path][1]
+
+    def key(self, alias):
+        spec = self.specs[alias]
+        options = tuple(sorted(spec['kwargs'].items()))
+        return (spec['path'], self.file_hash(spec['path']), spec['last_conv_layer'], options)
+
+    def get(self, alias):
+        """Return the model of an alias, loading it if it is not in memory"""
+        with self.lock:
+            key = self.key(alias)
+            model = self.instances.get(key)
+            if model is None:
+                loading = self.loading.setdefault(key, threading.Lock())
+        if model is None:
+            # other models are still served while this one is loaded and warmed up,
+            # concurrent requests of the same model wait for a single load
+            with loading:
+                with self.lock:
+                    model = self.instances.get(key)
+                if model is None:
+                    model = self.load(self.specs[alias], key)
+                    if self.warmup:
+                        model.warmup()
+                    with self.lock:
+                        self.instances[key] = model
+                        self.sizes[key] = self.model_size(model)
+                        self.last_used[key] = time.monotonic()
+                        self.loading.pop(key, None)
+        with self.lock:
+            if key in self.instances:
+                self.last_used[key] = time.monotonic()
+            self.evict(keep = key)
+        return model
+
+    def load(self, spec, key):
+        name = os.path.splitext(os.path.basename(spec['path']))[0]
+        if self.server is not None:
+            from components.predict.server import RemoteModel
+            return RemoteModel(name, spec['path'], spec['last_conv_layer'], self.server, **spec['kwargs'])
+        # tensorflow is only imported when a model is loaded in this process
+        from components.predict.model import Model
+        return Model(name, spec['path'], spec['last_conv_layer'], identity = f"{name}-{key[1]}", **spec['kwargs'])
+
+    def preload(self, aliases = None):
+        """Load the given aliases (all by default), useful to warm up a worker when it starts"""
+        for alias in (self.specs if aliases is None else aliases):
+            self.get(alias)
+
+    def model_size(self, model):
+        if not hasattr(model, 'model'):
+            # remote models keep their weights on the server
+            return 0
+        return sum(weight.shape.num_elements() * weight.dtype.size for weight in model.model.weights)
+
+    def memory_usage(self):
+        return sum(self.sizes.values())
+
+    def evict(self, keep = None):
+        """Drop the least recently used models that have been idle for idle_timeout seconds
+        while the loaded models exceed the memory budget
+        """
+        if self.memory_budget is None:
+            return
+        now = time.monotonic()
+        for key in sorted(self.instances, key = lambda k: self.last_used[k]):
+            if self.memory_usage() <= self.memory_budget:
+                break
+            if key == keep or now - self.last_used[key] < self.idle_timeout:
+                continue
+            del self.instances[key]
+            del self.sizes[key]
+            del self.last_used[key]
@@ -0,0 +1,253 @@
+"""Local inference server.
+A single process owns tensorflow and the models and serves batches of patches over a unix socket,
+so the web workers only need RemoteModel (no tensorflow) to predict.
+Run it from the app folder:
+    python -m components.predict.server --socket /tmp/breast_cancer_inference.sock --memory-budget 2048
+or let gunicorn start one for the host (see gunicorn.conf.py) with start_local_server.
+
+Protocol: every message is a 4 bytes (big endian) header length, a json header and the raw bytes
+of the arrays described in the header ({"arrays": [{"dtype": ..., "shape": ...}, ...], ...}).
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from components.predict.predictor import PatchPredictor
+
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'breast_cancer_inference.sock')
+
+
+def recv_exact(connection, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed by the other side")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def send_message(connection, header, arrays = ()):
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+    header = dict(header, arrays = [{'dtype': array.dtype.str, 'shape': array.shape} for array in arrays])
+    encoded = json.dumps(header).encode()
+    connection.sendall(struct.pack('!I', len(encoded)) + encoded)
+    for array in arrays:
+        connection.sendall(memoryview(array).cast('B'))
+
+
+def recv_message(connection):
+    size, = struct.unpack('!I', recv_exact(connection, 4))
+    header = json.loads(recv_exact(connection, size))
+    arrays = []
+    for spec in header.pop('arrays'):
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        data = recv_exact(connection, count * dtype.itemsize)
+        arrays.append(np.frombuffer(data, dtype=dtype).reshape(spec['shape']))
+    return header, arrays
+
+
+class InferenceHandler(socketserver.BaseRequestHandler):
+    """Serve the requests of one connection until the client closes it"""
+    def handle(self):
+        while True:
+            try:
+                header, arrays = recv_message(self.request)
+            except ConnectionError:
+                return
+            try:
+                response, outputs = self.server.dispatch(header, arrays)
+            except Exception as error:
+                response, outputs = {'error': f"{type(error).__name__}: {error}"}, []
+            send_message(self.request, response, outputs)
+
+
+class InferenceServer(socketserver.ThreadingUnixStreamServer):
+    """Own the models and answer the requests of RemoteModel clients"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, registry = None, memory_budget = None, idle_timeout = 600):
+        """
+        Args:
+            socket_path (str): Unix socket the server listens on.
+            registry (ModelRegistry, optional): Models of the server. Defaults to a new registry with
+                memory_budget and idle_timeout, the eviction of the models of every client happens here.
+        """
+        if registry is None:
+            from components.predict.registry import ModelRegistry
+            registry = ModelRegistry(memory_budget = memory_budget, idle_timeout = idle_timeout)
+        self.registry = registry
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, InferenceHandler)
+
+    def get_model(self, spec):
+        # the clients describe their model, the registry shares the instances with the same weights
+        alias = json.dumps(spec, sort_keys=True)
+        if alias not in self.registry:
+            # json turns tuples (e.g. patch_dim) into lists
+            kwargs = {key: tuple(value) if isinstance(value, list) else value for key, value in spec.get('kwargs', {}).items()}
+            self.registry.register(alias, spec['path'], spec['last_conv_layer'], **kwargs)
+        return self.registry[alias]
+
+    def dispatch(self, header, arrays):
+        model = self.get_model(header['model'])
+        operation = header['op']
+        if operation == 'info':
+            return {'identity': model.identity, 'patch_dim': list(model.patch_dim), 'batch_size': model.batch_size}, []
+        if operation == 'run':
+            outputs = model.run_compiled(header['name'], arrays[0])
+            return {}, list(outputs) if isinstance(outputs, (tuple, list)) else [outputs]
+        if operation == 'dense':
+            return {}, [model.predict_dense(arrays[0], header.get('stride'))]
+        if operation == 'window_stride':
+            return {'stride': model.get_window_stride(header['stride'])}, []
+        raise ValueError(f"unknown operation {operation}")
+
+
+class RemoteModel(PatchPredictor):
+    """Client mode of Model: same tint_image/tint_with_gradcam/tint_sliding_window API,
+    the inference runs on an InferenceServer listening on socket_path.
+    """
+    def __init__(self, name, path, last_conv_layer, socket_path, restart = True, **kwargs):
+        """
+        Args:
+            restart (bool, optional): Start a new server on socket_path (see start_local_server) when
+                none listens, e.g. after the previous one died. Defaults to True.
+        """
+        self.socket_path = socket_path
+        self.restart = restart
+        self.spec = {'path': os.path.realpath(path), 'last_conv_layer': last_conv_layer, 'kwargs': kwargs}
+        self.last_conv_layer = last_conv_layer
+        info, _ = self.request({'op': 'info'})
+        super().__init__(name, tuple(info['patch_dim']), info['batch_size'], info['identity'])
+
+    def connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            connection.close()
+            if not self.restart:
+                raise
+            # the server died (e.g. out of memory), the first client that notices starts a new one
+            start_local_server(self.socket_path)
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(self.socket_path)
+        return connection
+
+    def request(self, header, arrays = ()):
+        # one connection per request, so the client can be used from forked processes and threads
+        with self.connect() as connection:
+            send_message(connection, dict(header, model = self.spec), arrays)
+            response, outputs = recv_message(connection)
+        if 'error' in response:
+            raise RuntimeError(f"inference server error: {response['error']}")
+        return response, outputs
+
+    def warmup(self):
+        # the server warms its models up when it loads them
+        pass
+
+    def run_compiled(self, name, batch):
+        _, outputs = self.request({'op': 'run', 'name': name}, [np.asarray(batch, dtype=np.float32)])
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def get_window_stride(self, stride):
+        response, _ = self.request({'op': 'window_stride', 'stride': stride})
+        return response['stride']
+
+    def predict_dense(self, img_array, stride = None):
+        _, outputs = self.request({'op': 'dense', 'stride': stride}, [np.asarray(img_array, dtype=np.float32)])
+        return outputs[0]
+
+
+def is_listening(socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+def start_local_server(socket_path = DEFAULT_SOCKET, timeout = 60, owner = None):
+    """Make sure an inference server listens on socket_path, starting one for the host if there is none.
+    The server is a new interpreter (tensorflow is never forked) that outlives the web workers,
+    so every worker, thread and background job of the host shares its loaded models.
+    It exits with its owner process, INFERENCE_SERVER_OWNER (the gunicorn master) when owner is not given.
+    Returns socket_path.
+    """
+    if is_listening(socket_path):
+        return socket_path
+    if owner is None and os.environ.get("INFERENCE_SERVER_OWNER"):
+        owner = int(os.environ["INFERENCE_SERVER_OWNER"])
+    command = [sys.executable, '-m', 'components.predict.server', '--socket', socket_path]
+    if owner is not None:
+        command += ['--owner', str(owner)]
+    import fcntl
+    app_path = Path(os.path.dirname(os.path.realpath(__file__))).parent.parent.absolute()
+    # workers starting at the same time start a single server
+    with open(f"{socket_path}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not is_listening(socket_path):
+            subprocess.Popen(command, cwd=app_path, start_new_session=True)
+            deadline = time.monotonic() + timeout
+            while not is_listening(socket_path):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"the inference server did not start listening on {socket_path}")
+                time.sleep(0.1)
+    return socket_path
+
+
+def watch_owner(server, owner, interval = 5):
+    """Stop the server when the owner process exits, so it never outlives the app that uses it"""
+    while True:
+        time.sleep(interval)
+        try:
+            os.kill(owner, 0)
+        except ProcessLookupError:
+            server.shutdown()
+            return
+        except PermissionError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the prediction models over a unix socket")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--owner', type=int, default=None, help="pid of the process the server exits with")
+    # the defaults come from the environment, so servers started by start_local_server get them too
+    parser.add_argument('--memory-budget', type=int, default=os.environ.get("INFERENCE_SERVER_MEMORY_BUDGET"),
+        help="MB of weights kept in memory, least recently used idle models are evicted above it (default: no limit)")
+    parser.add_argument('--idle-timeout', type=int, default=os.environ.get("INFERENCE_SERVER_IDLE_TIMEOUT", 600),
+        help="seconds after which an unused model can be evicted")
+    args = parser.parse_args()
+
+    memory_budget = None if args.memory_budget is None else args.memory_budget * 1024 * 1024
+    server = InferenceServer(args.socket, memory_budget = memory_budget, idle_timeout = args.idle_timeout)
+    if args.owner is not None:
+        threading.Thread(target=watch_owner, args=(server, args.owner), daemon=True).start()
+    print(f"inference server listening on {args.socket}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Streaming scoring of whole slides.
+The slide is read in blocks of patches from a memory map: tiff and npy slides are mapped as they are and
+png slides are first decoded by strips to a temporary .npy file (see open_source), so the memory used
+does not depend on the size of the slide. Other formats, and interlaced or 16 bits pngs, are decoded
+whole and are only suited to small slides. The probability grid and the tinted overlay (the same
+tint_image gives for the whole slide) are written block by block to .npy files:
+    <output>/<name>.probs.npy     (rows, cols) float32 probabilities
+    <output>/<name>.overlay.npy   (H, W, 3) uint8 overlay of the padded slide, can be browsed with TilePyramid
+    <output>/<name>.json          shape, padding and model of the result, written last
+Run it from the app folder:
+    python -m components.predict.slide path/to/slide.tif --output slides
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from components.image.pyramid import open_source
+
+
+class SlideScorer:
+    """Score a slide block by block with a Model (or any PatchPredictor)"""
+    def __init__(self, model, block_size = 1024):
+        """
+        Args:
+            model (PatchPredictor): Model used to predict the patches.
+            block_size (int, optional): Side in pixels of the blocks read from the slide, rounded down
+                to a multiple of the patch size. Defaults to 1024.
+        """
+        self.model = model
+        PH = model.patch_dim[0]
+        PW = model.patch_dim[1]
+        self.block_rows = max(1, block_size // PH)
+        self.block_cols = max(1, block_size // PW)
+
+    def read_region(self, source, padding, row_range, col_range):
+        """uint8 pixels of a range of patch rows and cols of the padded slide, padding is white"""
+        PH = self.model.patch_dim[0]
+        PW = self.model.patch_dim[1]
+        top, _, left, _ = padding
+        y0, y1 = row_range[0] * PH - top, row_range[1] * PH - top
+        x0, x1 = col_range[0] * PW - left, col_range[1] * PW - left
+        region = np.full((y1 - y0, x1 - x0, 3), 255, dtype=np.uint8)
+        sy0, sy1 = max(y0, 0), min(y1, source.shape[0])
+        sx0, sx1 = max(x0, 0), min(x1, source.shape[1])
+        pixels = np.asarray(source[sy0:sy1, sx0:sx1])
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, np.newaxis]
+        region[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = pixels[:, :, :3]
+        return region
+
+    def blocks(self, rows, cols):
+        for row in range(0, rows, self.block_rows):
+            for col in range(0, cols, self.block_cols):
+                yield (row, min(row + self.block_rows, rows)), (col, min(col + self.block_cols, cols))
+
+    def score(self, path, output, progress = None):
+        """Score the slide of path and write its outputs on the output folder, returns the path of the json.
+        progress is an optional callable that receives the (done, total) patches.
+        """
+        model = self.model
+        PH = model.patch_dim[0]
+        PW = model.patch_dim[1]
+        source = open_source(path)
+        if source.dtype != np.uint8:
+            raise ValueError(f"{path}: only 8 bits slides are supported, got {source.dtype}")
+        padding = model.get_padding(source.shape)
+        top, bottom, left, right = padding
+        rows = (source.shape[0] + top + bottom) // PH
+        cols = (source.shape[1] + left + right) // PW
+
+        os.makedirs(output, exist_ok=True)
+        name = os.path.splitext(os.path.basename(path))[0]
+        probs_path = os.path.join(output, f"{name}.probs.npy")
+        overlay_path = os.path.join(output, f"{name}.overlay.npy")
+        probs = np.lib.format.open_memmap(probs_path, mode='w+', dtype=np.float32, shape=(rows, cols))
+        overlay = np.lib.format.open_memmap(overlay_path, mode='w+', dtype=np.uint8, shape=(rows * PH, cols * PW, 3))
+
+        # first pass, probabilities
+        done = 0
+        for row_range, col_range in self.blocks(rows, cols):
+            region = self.read_region(source, padding, row_range, col_range)
+            patches = model.get_patches(model.get_array_from_img(region)[0])
+            probs[row_range[0]:row_range[1], col_range[0]:col_range[1]] = model.predict_patches(patches)
+            done += patches.shape[0] * patches.shape[1]
+            if progress is not None:
+                progress(done, rows * cols)
+        probs.flush()
+
+        # second pass, overlay. Blocks are tinted with a margin of one patch, so the blur
+        # on their borders is the same tint_image gives for the whole slide
+        for row_range, col_range in self.blocks(rows, cols):
+            outer_rows = (max(row_range[0] - 1, 0), min(row_range[1] + 1, rows))
+            outer_cols = (max(col_range[0] - 1, 0), min(col_range[1] + 1, cols))
+            region = self.read_region(source, padding, outer_rows, outer_cols)
+            tinted = model.compose_tint(region, np.asarray(probs[outer_rows[0]:outer_rows[1], outer_cols[0]:outer_cols[1]]))
+            y0 = (row_range[0] - outer_rows[0]) * PH
+            x0 = (col_range[0] - outer_cols[0]) * PW
+            overlay[row_range[0] * PH:row_range[1] * PH, col_range[0] * PW:col_range[1] * PW] = \
+                tinted[y0:y0 + (row_range[1] - row_range[0]) * PH, x0:x0 + (col_range[1] - col_range[0]) * PW]
+        overlay.flush()
+        del probs, overlay
+
+        meta_path = os.path.join(output, f"{name}.json")
+        meta = {
+            'source': os.path.realpath(path), 'shape': list(source.shape), 'padding': list(padding),
+            'patch_dim': list(model.patch_dim), 'model': model.identity,
+            'probs': os.path.basename(probs_path), 'overlay': os.path.basename(overlay_path),
+        }
+        with open(meta_path, 'w') as file:
+            json.dump(meta, file)
+        return meta_path
+
+
+def main():
+    app_path = Path(os.path.dirname(os.path.realpath(__file__))).parent.parent.absolute()
+    parser = argparse.ArgumentParser(description="Score whole slides with bounded memory")
+    parser.add_argument('slides', nargs='+')
+    parser.add_argument('--output', default='slides')
+    parser.add_argument('--model', default=os.path.join(app_path, 'assets', 'models', 'classical_model.h5'))
+    parser.add_argument('--last-conv-layer', default='conv2d_2')
+    parser.add_argument('--block-size', type=int, default=1024)
+    args = parser.parse_args()
+
+    from components.predict.registry import ModelRegistry
+    registry = ModelRegistry()
+    registry.register('model', args.model, args.last_conv_layer)
+    scorer = SlideScorer(registry['model'], args.block_size)
+
+    for path in args.slides:
+        meta_path = scorer.score(path, args.output,
+            progress = lambda done, total: print(f"\r{os.path.basename(path)}: {done}/{total} patches", end=''))
+        print('\n', path, '->', meta_path)
+
+
+if __name__ == "__main__":
+    main()
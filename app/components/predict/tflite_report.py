@@ -0,0 +1,123 @@
+"""Accuracy and latency report of the quantized TFLite backends against the keras backend.
+Run it from the app folder:
+    python -m components.predict.tflite_report --data ../../Data --output assets/models/tflite_report.md
+
+--data is optional, a folder with labeled patches (*class0.png / *class1.png, as in model/initial_model_test.ipynb).
+Without it the report only compares the predictions of each backend with the keras ones on the sample images.
+
+The report is not shipped: it depends on the weights in assets/models, which are not in the repository.
+The prediction page only offers the float16 and int8 backends when assets/models/tflite_report.md exists,
+generate it there with the deployed weights once their accuracy and class agreement with keras were
+checked to be acceptable for that model.
+"""
+import argparse
+import glob
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from components.predict.model import Model
+
+
+def load_labeled_patches(data_path, limit, patch_dim):
+    paths = sorted(glob.glob(os.path.join(data_path, '**', '*class*.png'), recursive=True))
+    rng = np.random.default_rng(42)
+    paths = [paths[i] for i in rng.permutation(len(paths))[:limit]]
+    patches, labels = [], []
+    for path in paths:
+        image = Image.open(path).convert('RGB')
+        # some patches on the border of the slides are smaller
+        if image.size != (patch_dim[1], patch_dim[0]):
+            continue
+        patches.append(np.asarray(image, dtype=np.float32) / 255.0)
+        labels.append(1 if path.endswith('class1.png') else 0)
+    return np.stack(patches), np.array(labels)
+
+
+def sample_patches(model, image_paths):
+    patches = []
+    for path in image_paths:
+        img_array = model.get_array_from_img(np.asarray(Image.open(path).convert('RGB')))[0]
+        grid = model.get_patches(img_array)
+        patches.append(grid.reshape((-1,) + grid.shape[2:]))
+    return np.concatenate(patches)
+
+
+def predict(model, patches):
+    probs = np.empty(len(patches), dtype=np.float32)
+    for start in range(0, len(patches), model.batch_size):
+        batch = patches[start:start + model.batch_size]
+        probs[start:start + len(batch)] = model.run_compiled('predict', batch)[:, 0]
+    return probs
+
+
+def latency(model, patches, repeats):
+    batch = patches[:model.batch_size]
+    model.run_compiled('predict', batch)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.run_compiled('predict', batch)
+        times.append(time.perf_counter() - start)
+    return 1000 * np.median(times), len(batch) / np.median(times)
+
+
+def main():
+    app_path = Path(os.path.dirname(os.path.realpath(__file__))).parent.parent.absolute()
+    images_path = os.path.join(app_path, 'assets', 'imgs')
+    parser = argparse.ArgumentParser(description="Compare the TFLite backends with the keras backend")
+    parser.add_argument('--model', default=os.path.join(app_path, 'assets', 'models', 'classical_model.h5'))
+    parser.add_argument('--last-conv-layer', default='conv2d_2')
+    parser.add_argument('--data', default=None)
+    parser.add_argument('--limit', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    image_paths = sorted(glob.glob(os.path.join(images_path, 'sample_*.png')))
+    models = {
+        backend: Model(backend, args.model, args.last_conv_layer, backend = backend,
+            calibration_images = tuple(image_paths), tflite_threads = args.threads)
+        for backend in Model.BACKENDS
+    }
+
+    patches = sample_patches(models['keras'], image_paths)
+    reference = predict(models['keras'], patches)
+    labeled = load_labeled_patches(args.data, args.limit, models['keras'].patch_dim) if args.data else None
+
+    lines = [
+        "| backend | model size (KB) | max abs diff vs keras | class agreement vs keras | accuracy | batch latency (ms) | patches/s |",
+        "|---|---|---|---|---|---|---|",
+    ]
+    for backend, model in models.items():
+        probs = predict(model, patches)
+        size = os.path.getsize(args.model) if backend == 'keras' else len(model.get_tflite_model())
+        accuracy = "-"
+        if labeled is not None:
+            accuracy = f"{np.mean((predict(model, labeled[0]) > 0.5) == labeled[1]):.4f}"
+        milliseconds, throughput = latency(model, patches, args.repeats)
+        lines.append(
+            f"| {backend} | {size / 1024:.0f} | {np.max(np.abs(probs - reference)):.4f} "
+            f"| {np.mean((probs > 0.5) == (reference > 0.5)):.4f} | {accuracy} "
+            f"| {milliseconds:.2f} | {throughput:.0f} |"
+        )
+
+    report = "\n".join([
+        "# TFLite backends report",
+        "",
+        f"{len(patches)} patches of the sample images, batches of {models['keras'].batch_size} patches, "
+        f"{args.threads or 'default'} TFLite threads.",
+        "",
+    ] + lines) + "\n"
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+"""Gunicorn settings of the deployed app, gunicorn reads them from the working directory.
+The master starts the inference server (components/predict/server.py) before forking the workers,
+the server exits with the master and the workers restart it if it dies.
+INFERENCE_SERVER_MEMORY_BUDGET (MB) and INFERENCE_SERVER_IDLE_TIMEOUT (seconds) set when the server
+evicts the models it is not using (see components/predict/registry.py).
+"""
+import os
+import tempfile
+
+
+def on_starting(server):
+    from components.predict.server import start_local_server
+    # a socket per master, so a new deploy never reuses the server (and code) of a previous one
+    socket_path = os.environ.setdefault("INFERENCE_SERVER_SOCKET",
+        os.path.join(tempfile.gettempdir(), f"breast_cancer_inference.{os.getpid()}.sock"))
+    # the workers, and the servers they restart, belong to this master
+    os.environ["INFERENCE_SERVER_OWNER"] = str(os.getpid())
+    start_local_server(socket_path)
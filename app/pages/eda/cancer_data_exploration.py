@@ -15,6 +15,11 @@ from pathlib import Path
 
 from components.bars.deaths_barplot import BarPlot
 from components.geo.deaths_geo import GeoPlot
+from components.data.deaths_data import load_deaths_data, cancer_deaths
+from components.data.deaths_cube import DeathsCube
+from components.data.bitmap_index import BitmapIndex
+from components.data.population import PopulationLookup
+from components.geo.geometry import geojson_url
 
 
 
@@ -24,55 +29,10 @@ dash.register_page(__name__, path="/data-exploration")
 #See - https://dash.plotly.com/sharing-data-between-callbacks#why-global-variables-will-break-your-app
 
 def loadMainData():
-    path = Path(os.path.dirname(os.path.realpath(__file__)))
-    path = path.parent.parent.absolute()
-
-    path = os.path.join(path, 'assets', 'csv', 'muertes2020.csv')
-    data = pd.read_csv( path, sep=',', encoding='ISO-8859-1',
-                       dtype= {
-                           'COD_DPTO' : str,
-                           'COD_MUNIC' : str
-                        }) .drop(columns='Unnamed: 0')
-    
-    #Rename cancer categories
-    cancer_cats = [cat for cat in data['Causa'].unique()
-                   if 'tumor' in cat.lower() and 'maligno' in cat.lower()]
-
-    cancer_labels_map = {
-    'Tumor maligno de la mama de la mujer' : 'Seno',
-    'Tumor maligno de la próstata': 'Próstata', 
-    'Tumor maligno del estómago ' : 'Estómago',
-    'Tumor maligno de la tráquea, los bronquios y el pulmón ' : 'Traquea, Bronquios, Pulmón',
-    'Tumor maligno del colon, de la unión rectosigmoidea, recto y ano' : 'Colon, Recto, Ano',
-    'Tumor maligno del cuello del útero ' : 'Cuello del útero',
-    'Todos los demás tumores malignos del tejido linfático, de los órganos hematopoyéticos y de tejidos afines ' : 'T. Linfático, O. hematopoyéticos, T. Afines',
-    'Tumor maligno del ovario ' : 'Ovario', 
-    'Tumor maligno del páncreas ' : 'Páncreas',
-    'Tumor maligno del hígado ' : 'Hígado',
-    'Tumor maligno de sitios no especificados' : 'Sitios no especificados',
-    'Tumor maligno del encéfalo, del ojo y de otras partes del sistema nervioso central ': 'Encéfalo, Ojo, S. Nervioso Central',
-    'Tumor maligno de la vesícula biliar y de las vías biliares ' : 'Vesícula biliar',
-    'Tumor maligno de otras partes del útero' : 'Otras parter útero',
-    'Todos los demás tumores malignos de otras localizaciones ' : 'Otras localizaciones',
-    'Tumor maligno del esófago' : 'Esófago',
-    'Tumores malignos del labio, de la cavidad bucal y de la faringe ': 'Labio, Cavidad Bucal, Faringe',
-    'Melanoma y otros tumores malignos de la piel' : 'Melanoma, Piel',
-    'Todos los demás tumores malignos de los órganos urinarios' : 'O. Urinarios',
-    'Tumor maligno de la vejiga urinaria ': 'Vejiga urinaria',
-    'Tumor maligno del tiroides y de otras glandulas endocrinas ' : 'Tiroides, Glandulas Endocrinas',
-    'Tumor maligno de la laringe ' : 'Laringe',
-    'Todos los demás tumores malignos de los órganos digestivos y del peritoneo ' : 'O. Digestivos y Peritoneo',
-    'Tumores malignos de sitios mal definidos y secundarios ' : 'Sitios mal definidos, Secundarios',
-    'Tumor maligno de los huesos y de los cartilagos articulares': 'Huesos, Cartilagos articulares',
-    'Todos los demás tumores malignos de los órganos respiratorios e intratorácicos, excepto tráquea, bronquios y pulmón ' : 'Otros Respiratorios'
-    }
-
-    mask = data['Causa'].isin(cancer_cats)
-    
-    data.loc[mask, 'Causa'] = data.loc[mask, 'Causa'].map(cancer_labels_map) 
-
+    # cleaned dataset, cached as parquet by components/data/deaths_data.py
+    data = load_deaths_data()
     #filtered data
-    cancer_data = data[data['Causa'].isin([cancer_labels_map[cat] for cat in cancer_cats])]
+    cancer_data = cancer_deaths(data)
     return data, cancer_data 
 
 def loadPopulationData():
@@ -89,29 +49,19 @@ def loadPopulationData():
     return population_department
 
 def loadGeojson():
-    path = Path(os.path.dirname(os.path.realpath(__file__)))
-    path = path.parent.parent.absolute()
-    geo_path = os.path.join(path, 'assets', 'geo', 'colombia.geo.json')
-    # Read the geojson File containing the areas of interest coordinates
-    with open(geo_path) as geo:
-        geojson = json.loads(geo.read())
-    return geojson
+    # The figures reference the boundaries by URL, the browser downloads them once instead of
+    # receiving them in every figure. Simplified ones are built by components/geo/geometry.py
+    return geojson_url()
 
 def addPopulationInformation(data):
-    data = data.merge(loadPopulationData(), 
-                                    left_on = ['COD_DPTO'], 
-                                    right_on = ['DP'])
-    data = data.drop(columns=['DP', 'DPNOM'])
-    data = data.reset_index(drop = True) 
-    data = data.rename(columns = {'Total' : 'Poblacion', 
-                                  'Total Hombres' : 'Poblacion Hombres', 
-                                  'Total Mujeres' : 'Poblacion Mujeres'
-                                 })
-    return data    
+    # populations of the departments, loaded once
+    return population_lookup.add_to(data)
 
 def obtainCategories(data, category):
-    #just keep the first 15 
-    categories = data[category].unique()
+    # the sorted categories of the filter columns are precomputed by the index
+    if category in cancer_index.categories:
+        return cancer_index.categories[category]
+    categories = np.asarray(data[category].dropna().unique())
     categories.sort()
     return categories
 
@@ -120,6 +70,11 @@ def obtainCategories(data, category):
 data, cancer_data = loadMainData()
 geojson = loadGeojson()
 population_data = loadPopulationData()
+population_lookup = PopulationLookup(population_data)
+# deaths of every combination of the filter columns and the department, the plots query it instead of the records
+cancer_cube = DeathsCube(cancer_data)
+# bitmaps of the cube cells of every category, for the filters and the dropdown options
+cancer_index = BitmapIndex(cancer_cube)
 
 
 cancer_categories = obtainCategories(cancer_data, 'Causa')
@@ -131,8 +86,8 @@ cancer_columns = ['Causa', 'Sexo', 'Edad', 'Educacion', 'Etnia', 'Area_Residenci
 #tabs
 
 # Define instance of the components to use
-barplot_component : BarPlot = BarPlot(cancer_data, 'cancer_bars')
-geoplot_component : GeoPlot = GeoPlot(cancer_data, population_data, geojson, 'cancer_geo')
+barplot_component : BarPlot = BarPlot(cancer_data, 'cancer_bars', cube = cancer_cube, index = cancer_index)
+geoplot_component : GeoPlot = GeoPlot(cancer_data, population_data, geojson, 'cancer_geo', cube = cancer_cube, index = cancer_index)
 
 layout = dbc.Container(
     [
@@ -185,12 +140,8 @@ def update_barplot_var_2_types(variable):
     Input(barplot_component.second_variable_categories_id(), "value")
 )
 def render_barplot_content(var1, var1_types, var2, var2_types):
-    #update filters
-    barplot_component.first_variable = var1
-    barplot_component.second_variable = var2
-    barplot_component.first_variable_categories = var1_types
-    barplot_component.second_variable_categories = var2_types
-    return barplot_component.update_figure()
+    # the filters are passed to the component instead of stored on it, it is shared by every request of the worker
+    return barplot_component.update_figure(var1, var1_types or [], var2, var2_types or [])
 
 
 # GEO PLOT CALLBACKS
@@ -208,11 +159,13 @@ def render_barplot_content(var1, var1_types, var2, var2_types):
 def render_geoplot_content(
     Causa, Sexo, Edad, Educacion, Etnia, Area_Residencia, Seguridad_social    
 ):
-    geoplot_component.filter_by_column["Causa"] = Causa
-    geoplot_component.filter_by_column["Sexo"] = Sexo
-    geoplot_component.filter_by_column["Edad"] = Edad
-    geoplot_component.filter_by_column["Educacion"] = Educacion
-    geoplot_component.filter_by_column["Etnia"] = Etnia
-    geoplot_component.filter_by_column["Area_Residencia"] = Area_Residencia
-    geoplot_component.filter_by_column["Seguridad_social"] = Seguridad_social
-    return geoplot_component.update_figure()
+    # the filters are passed to the component instead of stored on it, it is shared by every request of the worker
+    return geoplot_component.update_figure({
+        "Causa" : Causa,
+        "Sexo" : Sexo,
+        "Edad" : Edad,
+        "Educacion" : Educacion,
+        "Etnia" : Etnia,
+        "Area_Residencia" : Area_Residencia,
+        "Seguridad_social" : Seguridad_social,
+    })
@@ -1,14 +1,18 @@
 import dash
 import dash_bootstrap_components as dbc
-from dash import Input, State, Output, dcc, html, callback, ctx
+from dash import Input, State, Output, dcc, html, callback, clientside_callback, ctx, ClientsideFunction
 import dash
 from skimage import io
 import os
+import tempfile
 from pathlib import Path
 import numpy as np
+import diskcache
 
 from components.image.visualizer import Visualizer
-from components.predict.model import Model
+from components.predict.registry import ModelRegistry
+from components.predict.cache import ResultCache
+from components.predict.precompute import load_probability_map, precompute_in_background
 
 
 dash.register_page(__name__, path="/cancer-prediction")
@@ -21,25 +25,57 @@ models_path = os.path.join(path, 'assets', 'models')
 images_path = os.path.join(path, 'assets', 'imgs')
 
 # Place here the images
-sample_images = [io.imread(os.path.join(images_path, f"sample_{i}.png")) for i in range(0,5)]
+sample_paths = [os.path.join(images_path, f"sample_{i}.png") for i in range(0,5)]
+sample_images = [io.imread(path) for path in sample_paths]
 blank_image = 165.0 * np.ones((500,500,3)).astype('float32')
 
-# Place here the models
-models = dict()
-models["Classical"] = Model("classical", os.path.join(models_path, 'classical_model.h5'), "conv2d_2")
-models["With regularization"] = Model("classical", os.path.join(models_path, 'classical_model.h5'), "conv2d_2")
+# Place here the models, they are loaded on first use and aliases of the same weights share one instance
+# If INFERENCE_SERVER_SOCKET is set the models run on that inference server (see components/predict/server.py),
+# gunicorn.conf.py sets it and starts the server. Tensorflow then never runs in the web workers, so the
+# background jobs, which are forked from them, do not fork it and every job reuses the models of the server.
+# Otherwise (e.g. the testing server of app.py) the models run in this process
+models = ModelRegistry(server = os.environ.get("INFERENCE_SERVER_SOCKET"))
+models.register("Classical", os.path.join(models_path, 'classical_model.h5'), "conv2d_2")
+models.register("With regularization", os.path.join(models_path, 'classical_model.h5'), "conv2d_2")
+# Post-training quantized versions, patch predictions run on TFLite. They are only offered once their accuracy
+# was checked, i.e. the report of components/predict/tflite_report.py for these weights is next to them
+if os.path.exists(os.path.join(models_path, 'tflite_report.md')):
+    models.register("Classical (float16)", os.path.join(models_path, 'classical_model.h5'), "conv2d_2", backend = 'float16')
+    models.register("Classical (int8)", os.path.join(models_path, 'classical_model.h5'), "conv2d_2", backend = 'int8',
+        calibration_images = tuple(sample_paths))
+
+# Load and trace the default model when the worker starts instead of on the first request
+models.preload(["Classical"])
+
+# Results of previous ROIs, shared by every worker of this host
+roi_cache = ResultCache()
+
+# Long predictions run as background jobs on local processes, the job queue lives on disk
+background_manager = dash.DiskcacheManager(
+    diskcache.Cache(os.path.join(tempfile.gettempdir(), 'breast_cancer_jobs'))
+)
 
 # Define prediction modes 
-prediction_modes = ['Tint patches', 'Grad-Cam Tint']
+prediction_modes = ['Tint patches', 'Grad-Cam Tint', 'Sliding window']
+# Strides (in pixels) between overlapping windows of the 'Sliding window' mode
+sliding_window_strides = [8, 16, 24, 32]
 
-selector_component : Visualizer = Visualizer(sample_images[0], 'Image', 'main-canvas')
-prediction_component : Visualizer = Visualizer( blank_image, 'Prediction', 'prediction-canvas', False)
+# Images are sent to the browser as JPEG, big images as a downscaled preview (ROIs are still full resolution)
+# and very large ones (e.g. whole slides) as a tile pyramid
+selector_component : Visualizer = Visualizer(sample_images[0], 'Image', 'main-canvas',
+    encoding = 'jpg', quality = 85, preview_size = 1024, tile_above = 4096, key = "sample_0")
+prediction_component : Visualizer = Visualizer( blank_image, 'Prediction', 'prediction-canvas', False,
+    encoding = 'jpg', quality = 90, key = "blank")
+# The figures of the sample images are built once, switching images reuses them
+selector_component.prebuild({f"sample_{index}" : image for index, image in enumerate(sample_images)})
 
 
 def generate_controls():
     return dbc.Card(
         [
             dcc.Store(id='local-data', data = {'model' : 'Classical', 'image' : 0, 'show-annotations' : False}),
+            # zoom and pan of the image when it is tiled
+            dcc.Store(id='selector-view', data = None),
             html.Div(
                 [
                     dbc.Label("Choose Image"),
@@ -79,6 +115,19 @@ def generate_controls():
                     ),
                 ]
             ),
+            html.Div(
+                [
+                    dbc.Label("Sliding window stride"),
+                    dcc.Dropdown(
+                        id="stride-select",
+                        options=[
+                            {"label": f"{stride} px", "value": stride} for stride in sliding_window_strides
+                        ],
+                        value=sliding_window_strides[1],
+                        className="dash-bootstrap"
+                    ),
+                ]
+            ),
             html.Div(
                 [
                     dbc.Checklist(
@@ -107,7 +156,15 @@ layout = html.Div(
                     [
                         dbc.Col(generate_controls(), md=2),
                         dbc.Col(selector_component.display(), md=5),
-                        dbc.Col(prediction_component.display(), md=5),
+                        dbc.Col(
+                            prediction_component.display() + [
+                                dbc.Progress(id="prediction-progress", value=0, max=1, striped=True, animated=True,
+                                    style={"display": "none"}),
+                                # prediction figure and its labels, rendered on the browser
+                                dcc.Store(id="prediction-data", data=None),
+                            ],
+                            md=5
+                        ),
                     ],
                 align="center",
                 ),
@@ -118,90 +175,153 @@ layout = html.Div(
 )
 
 #Callbacks
+# The callbacks do not change the components, everything they show comes from their inputs
+# (image and model in local-data, zoom in selector-view, ROI in relayoutData), so users
+# served by the same worker or thread never see each other's images
+
+def get_sample(local_data):
+    """Key and pixels of the chosen sample image"""
+    index = local_data['image']
+    return f"sample_{index}", sample_images[index]
+
+def get_main_figure(local_data, view = None):
+    key, image = get_sample(local_data)
+    pyramid = selector_component.get_pyramid(image, key)
+    if pyramid is not None:
+        return selector_component.get_tiled_figure(pyramid, view)
+    return selector_component.get_figure(key, image)
 
 # Update main figure either if a Rect is drawn or if a new image is selected
-def update_main_figure_on_rect_draw(relayout_data):
+def update_main_figure_on_rect_draw(relayout_data, local_data, view):
     if "shapes" in relayout_data:
-        updated_main_fig = selector_component.update_figure(relayout_data)
-        return updated_main_fig
-    else:
-        return dash.no_update
+        updated_main_fig = selector_component.keep_last_roi(get_main_figure(local_data, view), relayout_data)
+        return updated_main_fig, dash.no_update
+    # zoom or pan of a tiled image, only the tiles of the new view are requested
+    key, image = get_sample(local_data)
+    pyramid = selector_component.get_pyramid(image, key)
+    new_view = selector_component.get_view(relayout_data, pyramid, view) if pyramid is not None else None
+    if new_view is None:
+        return dash.no_update, dash.no_update
+    return selector_component.get_tiled_figure(pyramid, new_view), new_view
 
 def update_main_figure_on_choose_img(local_data):
-    updated_main_fig = selector_component.update_image(sample_images[local_data['image']])
-    return updated_main_fig
+    # the probability map of the chosen image is computed while the user draws the ROI
+    precompute_in_background(models, local_data['model'], sample_paths[local_data['image']])
+    updated_main_fig = get_main_figure(local_data)
+    return updated_main_fig, None
 
 @callback(
     Output(selector_component.figure_id(), "figure"),
+    Output('selector-view', 'data'),
     Input(selector_component.figure_id(), "relayoutData"),
     Input('local-data', 'data'),
+    State('selector-view', 'data'),
     prevent_initial_call=True,
 )
-def update_main_figure(relayout_data, local_data):
+def update_main_figure(relayout_data, local_data, view):
     triggered_id = ctx.triggered_id
     if(triggered_id == selector_component.figure_id()):
-        return update_main_figure_on_rect_draw(relayout_data)
+        return update_main_figure_on_rect_draw(relayout_data, local_data, view)
     elif(triggered_id == "local-data"):
         return update_main_figure_on_choose_img(local_data)
-    return dash.no_update
+    return dash.no_update, dash.no_update
+
+
+
+
+def render_prediction(model, roi, prediction_mode, arrays):
+    """Tinted ROI and annotations of a prediction mode given its probability (and heatmap) grids"""
+    if prediction_mode == 'Tint patches':
+        return model.render_tint(roi, arrays['probs'])
+    elif prediction_mode == 'Grad-Cam Tint':
+        roi, _, annotations = model.render_gradcam(roi, arrays['heatmaps'], arrays['probs'])
+        return roi, annotations
+    elif prediction_mode == 'Sliding window':
+        return model.render_sliding_window(roi, arrays['probs'], int(arrays['stride']))
+    return roi, []
 
+def predict_roi(roi, origin, image_index, model_name, prediction_mode, stride, progress = None):
+    """Apply the prediction mode to a ROI, reusing the result if the same ROI was already predicted.
+    origin is the (row, col) of the ROI on the sample image image_index.
+    progress is an optional callable that receives the (done, total) patches.
+    """
+    model = models[model_name]
+    if prediction_mode != 'Sliding window':
+        stride = None
+    elif stride is None:
+        # the stride dropdown was cleared
+        stride = model.DEFAULT_WINDOW_STRIDE
+    # only the probability (and heatmap) grids are cached, the tinted ROI is rendered again from them
+    # ('grids' keeps the entries of the rendered ROIs stored by older versions from being read)
+    key = roi_cache.key(roi, model.identity, tuple(model.patch_dim), prediction_mode, stride, 'grids')
+    cached = roi_cache.get(key)
+    if cached is not None:
+        arrays, _ = cached
+        return render_prediction(model, roi, prediction_mode, arrays)
 
+    arrays = dict()
+    if prediction_mode == 'Tint patches':
+        probability_map = load_probability_map(model, sample_paths[image_index])
+        arrays['probs'] = model.tint_probabilities(roi, probability_map, origin, progress = progress)
+    elif prediction_mode == 'Grad-Cam Tint':
+        arrays['heatmaps'], arrays['probs'] = model.gradcam_heatmaps(roi, progress = progress)
+    elif prediction_mode == 'Sliding window':
+        arrays['probs'], window_stride = model.sliding_window_probabilities(roi, stride, progress = progress)
+        arrays['stride'] = np.array(window_stride)
+
+    roi_cache.set(key, arrays, [])
+    return render_prediction(model, roi, prediction_mode, arrays)
 
 
 @callback(
-    Output(prediction_component.figure_id(), "figure"),
+    Output("prediction-data", "data"),
     Input(selector_component.figure_id(), "relayoutData"),
     State('local-data', 'data'),
     State('prediction-mode', 'value'),
+    State('stride-select', 'value'),
+    # a job triggered by a new ROI supersedes the running one, which is terminated
+    background=True,
+    manager=background_manager,
+    running=[
+        (Output("prediction-progress", "style"), {"display": "flex"}, {"display": "none"}),
+    ],
+    progress=[Output("prediction-progress", "value"), Output("prediction-progress", "max")],
+    cancel=[Input("image-select", "value")],
     prevent_initial_call=True,
 )
-def update_roi_figure_on_selection(relayout_data, local_data, prediction_mode):
+def update_roi_figure_on_selection(set_progress, relayout_data, local_data, prediction_mode, stride):
     if "shapes" in relayout_data:
         annotations = []
-        roi = selector_component.get_roi(relayout_data)
+        _, image = get_sample(local_data)
+        roi = selector_component.get_roi(relayout_data, image)
         # apply prediction
-        # modes: 'Tint patches', 'Grad-Cam Heatmap', 'Grad-Cam Tint'
+        # modes: 'Tint patches', 'Grad-Cam Heatmap', 'Grad-Cam Tint', 'Sliding window'
         if roi is not None:
-            if prediction_mode == 'Tint patches':
-                roi, annotations = models[local_data['model']].tint_image(roi)
-            elif prediction_mode == 'Grad-Cam Tint':
-                roi , _, annotations = models[local_data['model']].tint_with_gradcam(roi)
-                
+            x0, y0, _, _ = selector_component.get_roi_box(relayout_data)
+            roi, annotations = predict_roi(roi, (y0, x0), local_data['image'], local_data['model'], prediction_mode, stride,
+                progress = lambda done, total: set_progress((done, total)))
+            updated_pred_fig = prediction_component.build_figure(roi).to_plotly_json()
         else:
-            roi = blank_image
-        updated_pred_fig = prediction_component.update_image(roi) 
+            updated_pred_fig = prediction_component.get_figure("blank", blank_image)
+        # a new prediction resets the zoom, the labels keep it
+        updated_pred_fig['layout']['uirevision'] = str(relayout_data["shapes"][-1])
 
+        labels = None
         if local_data['show-annotations']:
-            for annotation in annotations:
-                updated_pred_fig.add_annotation(
-                    x=annotation['x'], y=annotation['y'],
-                    text=annotation['text'],
-                        xref="x",
-                        yref="y",
-                        showarrow=True,
-                        font=dict(
-                            family="Courier New, monospace",
-                            size=16,
-                            color="#ffffff"
-                            ),
-                        align="center",
-                        arrowhead=2,
-                        arrowsize=1,
-                        arrowwidth=2,
-                        arrowcolor="#000000",
-                        ax=20,
-                        ay=-30,
-                        bordercolor="#ffffff",
-                        borderwidth=2,
-                        borderpad=4,
-                        bgcolor="#000000",
-                        opacity=0.8
-                    )
-
-        return updated_pred_fig
+            labels = prediction_component.get_labels(annotations)
+        return {'figure' : updated_pred_fig, 'labels' : labels}
     else:
         return dash.no_update
 
+# The patch probabilities are drawn as a single trace, thinned on the browser for the current zoom
+clientside_callback(
+    ClientsideFunction(namespace="prediction", function_name="render_labels"),
+    Output(prediction_component.figure_id(), "figure"),
+    Input("prediction-data", "data"),
+    Input(prediction_component.figure_id(), "relayoutData"),
+    prevent_initial_call=True,
+)
+
 @callback(
     Output('local-data', 'data'),
     Input("image-select", "value"),